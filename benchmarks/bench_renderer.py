@@ -0,0 +1,83 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code_tracer"))
+
+from video_creator import chunk_frames, get_font_size, get_frames  # noqa: E402
+
+# Renderer and whether frames are drawn from the previous frame of the file
+MODES = {"pygments": ("pygments", False), "atlas": ("atlas", False), "incremental": ("atlas", True)}
+
+
+def create_line(rng, number):
+    indent = "    " * rng.randint(0, 3)
+    return f'{indent}value_{number} = compute({rng.randint(0, 1000)}, "text")  # note\n'
+
+
+# Snapshots of a Python module that is written out and then edited a few lines at a time, shaped like
+# the change files video_creator works on
+def create_change_files(line_count, snapshot_count, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    change_files = []
+    for index in range(snapshot_count):
+        if index < snapshot_count // 2:
+            for _ in range(max(line_count // (snapshot_count // 2 or 1), 1)):
+                lines.append(create_line(rng, len(lines)))
+        else:
+            position = rng.randrange(len(lines))
+            lines[position : position + 2] = [create_line(rng, position), create_line(rng, position + 1)]
+        content = "".join(lines[:line_count])
+        change_files.append(
+            {
+                "filepath": "module.py",
+                "project_name": "bench",
+                "github_username": "bench",
+                "language": "python",
+                "content": content,
+                "total_lines": len(content.split("\n")),
+                "index": index,
+            }
+        )
+    max_lines = max(change_file["total_lines"] for change_file in change_files)
+    return [{**change_file, "max_lines": max_lines} for change_file in change_files]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the Pygments and glyph atlas code renderers.")
+    parser.add_argument("--lines", type=int, default=400)
+    parser.add_argument("--snapshots", type=int, default=20)
+    parser.add_argument("--chunk-size", type=int, default=8)
+    parser.add_argument("--width", type=int, default=4096)
+    parser.add_argument("--height", type=int, default=2160)
+    args = parser.parse_args()
+
+    dimensions = [args.width, args.height]
+    change_files = create_change_files(args.lines, args.snapshots)
+    resolution = {"name": "bench", "dimensions": dimensions}
+    font_size = get_font_size(change_files[-1], resolution, "video", "atlas")[2]
+    print(f"{args.snapshots} snapshots of up to {args.lines} lines at {args.width}x{args.height}, font {font_size}")
+
+    frames = {}
+    for mode, (renderer, incremental) in MODES.items():
+        frame_args = [(change_file, dimensions, font_size, None, renderer, incremental) for change_file in change_files]
+        start = time.perf_counter()
+        frames[mode] = [img for chunk in chunk_frames(frame_args, args.chunk_size) for img, _ in get_frames(chunk)]
+        elapsed = time.perf_counter() - start
+        print(f"{mode:>11}: {elapsed * 1000 / len(change_files):.1f} ms/frame")
+
+    for mode in list(MODES)[1:]:
+        difference = max(
+            int(np.abs(expected.astype(np.int16) - actual.astype(np.int16)).max())
+            for expected, actual in zip(frames["pygments"], frames[mode])
+        )
+        print(f"max pixel difference, {mode}: {difference}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import fnmatch
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code_tracer"))
+
+from constants import DEFAULTS  # noqa: E402
+from scanner import scan_paths  # noqa: E402
+from utils import Config, logger  # noqa: E402
+
+
+# The path expansion and ignore filtering the watcher used before scan_paths, kept as the baseline
+def expand_wildcards(paths):
+    new_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            new_paths.extend(glob.glob(os.path.join(path, "**"), recursive=True))
+        elif "**" in path or "*" in path:
+            new_paths.extend(glob.glob(path, recursive=True))
+        else:
+            new_paths.append(path)
+    new_new_paths = []
+
+    for path in new_paths:
+        new_new_paths.append(path)
+        if os.path.isdir(path):
+            new_new_paths.extend(expand_wildcards(glob.glob(os.path.join(path, "**/.*"), recursive=True)))
+
+    new_new_paths = [path for path in new_new_paths if os.path.isfile(path)]
+
+    return new_new_paths
+
+
+def remove_ignored(paths, config):
+    ignored_paths = config.get("ignore")
+    logger.info(
+        "Removing"
+        f" {len([path for path in paths if any([fnmatch.fnmatch(path, ignore) for ignore in ignored_paths])])} ignored"
+        " paths"
+    )
+    return [path for path in paths if not any([fnmatch.fnmatch(path, ignore) for ignore in ignored_paths])]
+
+
+def get_paths(key, config):
+    logger.info(f"Getting {key} paths from config")
+    items = config.get(key)
+    items = [os.path.expanduser(item) for item in items]
+    items = [os.path.join(config.get("project_dir"), item) for item in items]
+    items = expand_wildcards(items)
+    logger.info(f"Found {len(items)} expanded paths for config['{key}']")
+    return items
+
+
+# Build a project tree where most files live in directories the default ignore list drops
+def create_tree(project_dir, total_files):
+    layout = [
+        ("src", 0.15),
+        ("node_modules", 0.45),
+        ("venv/lib/python3.11/site-packages", 0.25),
+        (".git/objects", 0.10),
+        ("output/changes", 0.05),
+    ]
+    for directory, share in layout:
+        count = int(total_files * share)
+        for i in range(count):
+            subdirectory = os.path.join(project_dir, directory, f"pkg{i // 500}", f"mod{i // 50}")
+            os.makedirs(subdirectory, exist_ok=True)
+            name = f".hidden{i}.py" if i % 20 == 0 else f"file{i}.py"
+            with open(os.path.join(subdirectory, name), "w") as f:
+                f.write("")
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare get_paths + remove_ignored against scan_paths.")
+    parser.add_argument("--files", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    project_dir = tempfile.mkdtemp(prefix="code_tracer_bench_")
+    try:
+        print(f"Creating {args.files} files in {project_dir}...")
+        create_tree(project_dir, args.files)
+        config_filepath = os.path.join(project_dir, "tracer.json")
+        with open(config_filepath, "w") as f:
+            json.dump({**DEFAULTS, "watch": ["**"], "log_level": "CRITICAL"}, f)
+        config = Config(config_filepath)
+        config.set("project_dir", project_dir, local=True)
+
+        legacy_times, scan_times = [], []
+        for _ in range(args.repeat):
+            legacy_time, legacy_paths = timed(lambda: remove_ignored(get_paths("watch", config), config))
+            scan_time, scanned_paths = timed(lambda: scan_paths("watch", config))
+            legacy_times.append(legacy_time)
+            scan_times.append(scan_time)
+
+        print(
+            f"get_paths + remove_ignored: {min(legacy_times):.3f}s"
+            f" ({len(legacy_paths)} paths, {len(set(legacy_paths))} unique)"
+        )
+        print(f"scan_paths:                 {min(scan_times):.3f}s ({len(scanned_paths)} paths)")
+        print(f"speedup:                    {min(legacy_times) / min(scan_times):.1f}x")
+        if set(legacy_paths) != set(scanned_paths):
+            print(f"WARNING: watch sets differ by {len(set(legacy_paths) ^ set(scanned_paths))} paths")
+    finally:
+        shutil.rmtree(project_dir)
+
+
+if __name__ == "__main__":
+    main()
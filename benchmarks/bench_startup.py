@@ -0,0 +1,70 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+CODE_TRACER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code_tracer")
+
+# Script and arguments of each subcommand, and its budget for importing everything it needs before its
+# first prompt, in milliseconds
+SUBCOMMANDS = {
+    "help": (["commands.py"], 100),
+    "init": (["commands.py", "init"], 100),
+    "sessions": (["commands.py", "sessions"], 100),
+    "migrate_changes": (["commands.py", "migrate_changes"], 100),
+    "generate_video": (["commands.py", "generate_video"], 500),
+    "watch": (["watch_directories.py"], 150),
+}
+
+
+# Run a subcommand with no input, so it stops at its first prompt, and add up the import times of the
+# modules it imported at the top level
+def measure(args):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=CODE_TRACER_DIR,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    import_us = 0
+    modules = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        modules += 1
+        # Top level imports are not indented and their cumulative times include everything below them
+        if not name[1:].startswith(" "):
+            import_us += int(cumulative)
+    return import_us / 1000, elapsed * 1000, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the start-up imports of each code tracer subcommand.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("subcommands", nargs="*", default=list(SUBCOMMANDS))
+    args = parser.parse_args()
+
+    over_budget = []
+    for subcommand in args.subcommands:
+        command, budget = SUBCOMMANDS[subcommand]
+        import_ms, elapsed_ms, modules = min(measure(command) for _ in range(args.repeat))
+        status = "ok" if import_ms <= budget else "OVER BUDGET"
+        print(
+            f"{subcommand:>15}: {import_ms:7.1f} ms imports ({modules} modules), {elapsed_ms:7.1f} ms wall, "
+            f"budget {budget} ms {status}"
+        )
+        if import_ms > budget:
+            over_budget.append(subcommand)
+
+    if over_budget:
+        sys.exit(f"Over the start-up budget: {', '.join(over_budget)}")
+
+
+if __name__ == "__main__":
+    main()
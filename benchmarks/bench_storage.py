@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code_tracer"))
+
+from constants import DEFAULTS, TIME_FORMAT  # noqa: E402
+from storage import load_change_files, open_journal  # noqa: E402
+from utils import Config  # noqa: E402
+from watch_directories import copy_file, human_readable_size  # noqa: E402
+
+FORMATS = {
+    "inline": {"storage_format": "files", "blob_store": False, "storage_mode": "full"},
+    "blobs": {"storage_format": "files", "blob_store": True, "storage_mode": "full"},
+    "delta": {"storage_format": "files", "blob_store": True, "storage_mode": "delta"},
+    "journal": {"storage_format": "journal", "blob_store": True, "storage_mode": "full"},
+    "journal+delta": {"storage_format": "journal", "blob_store": True, "storage_mode": "delta"},
+}
+
+
+# Simulate an editing session: each change rewrites, inserts or deletes a few lines
+def create_session(line_count, edit_count, seed=0):
+    rng = random.Random(seed)
+    lines = [f"    value_{i} = compute({i}, {rng.randint(0, 1000)})  # line {i}\n" for i in range(line_count)]
+    snapshots = []
+    for edit in range(edit_count):
+        position = rng.randrange(len(lines))
+        action = rng.random()
+        if action < 0.6:
+            for offset in range(rng.randint(1, 5)):
+                if position + offset < len(lines):
+                    lines[position + offset] = f"    value_{position + offset} = edited({edit})\n"
+        elif action < 0.85:
+            lines[position:position] = [f"    added_{edit}_{i} = {i}\n" for i in range(rng.randint(1, 10))]
+        else:
+            del lines[position : position + rng.randint(1, 5)]
+        snapshots.append("".join(lines))
+    return snapshots
+
+
+def directory_size(directory):
+    total_size = 0
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            total_size += os.path.getsize(os.path.join(root, filename))
+    return total_size
+
+
+def run_format(name, settings, snapshots, keyframe_interval, work_dir):
+    project_dir = os.path.join(work_dir, name)
+    output_dir = os.path.join(project_dir, "output")
+    os.makedirs(project_dir)
+    config_filepath = os.path.join(project_dir, "tracer.json")
+    with open(config_filepath, "w") as f:
+        json.dump(
+            {
+                **DEFAULTS,
+                **settings,
+                "keyframe_interval": keyframe_interval,
+                "github_username": "bench",
+                "log_level": "CRITICAL",
+            },
+            f,
+        )
+    config = Config(config_filepath)
+
+    filepath = os.path.join(project_dir, "module.py")
+    history = {}
+    journal = open_journal(output_dir, config) if config.get("storage_format") == "journal" else None
+    start = time.perf_counter()
+    for index, content in enumerate(snapshots):
+        with open(filepath, "w") as f:
+            f.write(content)
+        timestamp = time.strftime(TIME_FORMAT, time.localtime(1_700_000_000 + index))
+        copy_file(filepath, output_dir, timestamp, "bench", config, history, journal)
+    if journal:
+        journal.close()
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    change_files = load_change_files(output_dir)
+    load_time = time.perf_counter() - start
+
+    if [change_file["content"] for change_file in change_files] != snapshots:
+        raise AssertionError(f"{name}: reconstructed contents do not match the session")
+    return directory_size(output_dir), write_time, load_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare snapshot storage formats.")
+    parser.add_argument("--lines", type=int, default=3000)
+    parser.add_argument("--edits", type=int, default=500)
+    parser.add_argument("--keyframe-interval", type=int, default=DEFAULTS["keyframe_interval"])
+    args = parser.parse_args()
+
+    snapshots = create_session(args.lines, args.edits)
+    work_dir = tempfile.mkdtemp(prefix="code_tracer_bench_")
+    try:
+        print(f"{args.edits} edits of a {args.lines}-line file, keyframe every {args.keyframe_interval} changes")
+        for name, settings in FORMATS.items():
+            size, write_time, load_time = run_format(name, settings, snapshots, args.keyframe_interval, work_dir)
+            print(
+                f"{name:>13}: {human_readable_size(size):>10} on disk, write {write_time:.2f}s, load {load_time:.3f}s"
+            )
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
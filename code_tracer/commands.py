@@ -1,10 +1,10 @@
 import argparse
+import glob
 import json
 import os
-import glob
-from video_creator import create_media
-from utils import logger
+
 from constants import DEFAULTS
+from utils import Config, logger
 
 
 def init_config_file():
@@ -53,7 +53,7 @@ def init_config_file():
             if os.path.isdir(selection_path):
                 # If the selection is a directory, prompt the user to select files or all files
                 while True:
-                    print(f'Select a file to watch or choose an option:')
+                    print('Select a file to watch or choose an option:')
                     files = glob.glob(os.path.join(selection_path, '*'))
                     files.sort()
                     for i, file in enumerate(files):
@@ -120,7 +120,7 @@ You are being provided a json file with the following format:
     "total_progress": *summary of progress made up to this session*,
     "sessions": *the sessions that are being rendered in this video*,
     "sub_project": *the sub-project that is being worked on*
-    "changes": *starting and final state for this session*,
+    "changes": *a unified diff per file, from its starting to its final state for this session*,
     "seconds": *desired manuscript length (shoot for just under this)*
 }
 
@@ -138,8 +138,62 @@ Your response will be a proper json object that looks like this:
     logger.info("Configuration file created successfully.")
 
 
-def generate_video():
-    create_media()
+# Subcommands import the modules they use when they run, so init and sessions do not wait for the
+# rendering and GPT modules to load
+def generate_video(regenerate_manuscript=False):
+    from video_creator import create_media
+
+    create_media(regenerate_manuscript)
+
+
+def list_sessions(session=None):
+    from journal import get_journal_dir
+    from snapshot_index import open_snapshot_index
+    from storage import legacy_file_counts
+
+    project_dir = os.path.expanduser(input('Enter the path to the project directory: '))
+    config = Config(os.path.join(project_dir, 'tracer.json'))
+    output_dir = os.path.expanduser(config.get("output_dir"))
+
+    # Journal snapshots are counted from the snapshot index without reading their contents. Snapshots
+    # still in the per-file layout are not in the index, so they are counted from their files.
+    index = open_snapshot_index(output_dir)
+    try:
+        index.sync(get_journal_dir(output_dir))
+        file_counts = {
+            (name, filepath): (changes, first, last)
+            for name, filepath, changes, first, last in index.file_counts(session)
+        }
+    finally:
+        index.close()
+    for key, (changes, first, last) in legacy_file_counts(output_dir).items():
+        if session in (None, key[0]):
+            indexed_changes, indexed_first, indexed_last = file_counts.get(key, (0, first, last))
+            file_counts[key] = (indexed_changes + changes, min(indexed_first, first), max(indexed_last, last))
+
+    sessions = {}
+    for (name, _), (changes, first, last) in file_counts.items():
+        total_changes, files, session_first, session_last = sessions.get(name, (0, 0, first, last))
+        sessions[name] = (total_changes + changes, files + 1, min(session_first, first), max(session_last, last))
+
+    print(f'{"Session":<20} {"Changes":>8} {"Files":>6}  {"First change":<19}  {"Last change":<19}')
+    for name, (changes, files, first, last) in sorted(sessions.items(), key=lambda item: item[1][2]):
+        print(f'{name:<20} {changes:>8} {files:>6}  {first:<19}  {last:<19}')
+    print()
+    current_session = None
+    for (name, filepath), (changes, _, _) in sorted(file_counts.items(), key=lambda item: (item[0][0], -item[1][0])):
+        if name != current_session:
+            print(f'{name}:')
+            current_session = name
+        print(f'  {changes:>6}  {filepath}')
+
+
+def migrate_changes():
+    from storage import migrate_change_files
+
+    project_dir = os.path.expanduser(input('Enter the path to the project directory: '))
+    config = Config(os.path.join(project_dir, 'tracer.json'))
+    migrate_change_files(os.path.expanduser(config.get("output_dir")), config)
 
 
 if __name__ == '__main__':
@@ -152,6 +206,16 @@ if __name__ == '__main__':
     generate_video_parser = subparsers.add_parser(
         "generate_video", help="Generate a video from the saved code changes."
     )
+    generate_video_parser.add_argument(
+        "--regenerate-manuscript",
+        action="store_true",
+        help="Request a new manuscript even if one is cached for the same payload.",
+    )
+    sessions_parser = subparsers.add_parser("sessions", help="List recorded sessions and per-file change counts.")
+    sessions_parser.add_argument("--session", help="Only show this session.")
+    migrate_changes_parser = subparsers.add_parser(
+        "migrate_changes", help="Pack the per-file change snapshots into the change journal."
+    )
 
     # Parse the arguments
 
@@ -161,6 +225,10 @@ if __name__ == '__main__':
     if args.command == 'init':
         init_config_file()
     elif args.command == 'generate_video':
-        generate_video()
+        generate_video(args.regenerate_manuscript)
+    elif args.command == 'sessions':
+        list_sessions(args.session)
+    elif args.command == 'migrate_changes':
+        migrate_changes()
     else:
         parser.print_help()
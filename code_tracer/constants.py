@@ -24,6 +24,23 @@ DEFAULTS = {
         "**context.txt",
     ],
     "interval": 1,
+    "watch_backend": "inotify",
+    "debounce_seconds": 0.5,
+    "debounce_max_seconds": 5,
+    "max_snapshots_per_minute": 20,
+    "writer_threads": 2,
+    "writer_queue_size": 256,
+    "max_snapshot_size": 2097152,
+    "mmap_threshold": 1048576,
+    "stats_interval": 10,
+    "metrics_port": 0,
+    "storage_format": "journal",
+    "journal_compression": True,
+    "journal_segment_size": 67108864,
+    "snapshot_index": True,
+    "blob_store": True,
+    "storage_mode": "full",
+    "keyframe_interval": 50,
     "video_length": 60,
     "video_fps": 60,
     "gifs": False,
@@ -38,12 +55,35 @@ DEFAULTS = {
         {"name": "landscape", "dimensions": [4096, 2160]},
         {"name": "portrait", "dimensions": [2160, 4096]},
     ],
+    "renderer": "atlas",
+    "frame_window": 64,
+    "incremental_render": True,
+    "render_chunk_size": 8,
+    "video_segments": 1,
+    "shared_memory_frames": True,
+    "hold_frames": True,
+    "frame_cache": False,
+    "frame_cache_size": 2147483648,
     "log_level": "INFO",
     "multi_processing": True,
     "session": "default",
     "render_sessions": ["default"],
     "all_sessions": ["default"],
     "openai_api_key": "",
+    "payload_diffs": True,
+    "payload_diff_context": 3,
+    "payload_token_budget": 100000,
+    "payload_interactive": False,
+    "manuscript_backend": "openai",
+    "manuscript_replay_filepath": "",
+    "manuscript_cache": True,
+    "regenerate_manuscript": False,
+    "tts_backend": "google",
+    "tts_fixture_filepath": "",
+    "tts_language_code": "en-US",
+    "tts_voice_gender": "NEUTRAL",
+    "tts_cache": True,
+    "tts_workers": 4,
     "video_catch_phrase": "Howdy!",
     "sub_project": "main",
     "total_progress": "Just the beginning...",
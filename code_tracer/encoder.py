@@ -0,0 +1,168 @@
+import collections
+import fractions
+import os
+import queue
+import subprocess
+
+import numpy as np
+from moviepy.config import get_setting
+
+from utils import logger
+
+
+def get_ffmpeg_binary():
+    return get_setting("FFMPEG_BINARY")
+
+
+# Raw RGB frames piped into ffmpeg as they are produced, with the same encoding settings moviepy's
+# write_videofile uses. Only the frame being written is held in memory. fps may be a fraction, so a
+# frame can be shown for several output frames' worth of time without being encoded again.
+class FrameEncoder:
+    def __init__(self, output_filepath, dimensions, fps, codec="libx264", preset="medium"):
+        self.output_filepath = output_filepath
+        self.dimensions = tuple(dimensions)
+        self.fps = fractions.Fraction(fps).limit_denominator(1000000)
+        self.frame_count = 0
+        command = [
+            get_ffmpeg_binary(),
+            "-y",
+            "-loglevel", "error",
+            "-f", "rawvideo",
+            "-vcodec", "rawvideo",
+            "-s", f"{dimensions[0]}x{dimensions[1]}",
+            "-pix_fmt", "rgb24",
+            "-r", f"{self.fps.numerator}/{self.fps.denominator}",
+            "-an", "-i", "-",
+            "-vcodec", codec,
+            "-preset", preset,
+        ]  # fmt: skip
+        if codec == "libx264" and dimensions[0] % 2 == 0 and dimensions[1] % 2 == 0:
+            command.extend(["-pix_fmt", "yuv420p"])
+        command.append(output_filepath)
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+
+    @property
+    def duration(self):
+        return float(self.frame_count / self.fps)
+
+    def write(self, frame, repeat=1):
+        if (frame.shape[1], frame.shape[0]) != self.dimensions:
+            raise ValueError(f"Frame of {frame.shape[1]}x{frame.shape[0]} does not match the video {self.dimensions}")
+        data = memoryview(np.ascontiguousarray(frame, dtype=np.uint8)).cast("B")
+        try:
+            for _ in range(repeat):
+                self.process.stdin.write(data)
+        except BrokenPipeError:
+            self.close()
+            raise
+        self.frame_count += repeat
+
+    def close(self):
+        if self.process.stdin and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        error = self.process.stderr.read()
+        self.process.stderr.close()
+        if self.process.wait():
+            raise RuntimeError(f"ffmpeg failed to write {self.output_filepath}: {error.decode(errors='replace')}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Add an audio track to a video without re-encoding the video, cut to the video's duration like
+# clip.set_audio in moviepy. A video encoded in segments is joined with ffmpeg's concat demuxer in the
+# same pass.
+def mux_audio(video_filepaths, audio_filepath, output_filepath, duration):
+    if isinstance(video_filepaths, str):
+        video_filepaths = [video_filepaths]
+    list_filepath = None
+    if len(video_filepaths) == 1:
+        video_input = ["-i", video_filepaths[0]]
+    else:
+        list_filepath = f"{output_filepath}.segments.txt"
+        with open(list_filepath, "w") as f:
+            for video_filepath in video_filepaths:
+                escaped_filepath = os.path.abspath(video_filepath).replace("'", "'\\''")
+                f.write(f"file '{escaped_filepath}'\n")
+        video_input = ["-f", "concat", "-safe", "0", "-i", list_filepath]
+    command = [
+        get_ffmpeg_binary(),
+        "-y",
+        "-loglevel", "error",
+        *video_input,
+        "-i", audio_filepath,
+        "-map", "0:v:0",
+        "-map", "1:a:0",
+        "-c:v", "copy",
+        "-c:a", "copy",
+        "-t", f"{duration:.03f}",
+        output_filepath,
+    ]  # fmt: skip
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    finally:
+        if list_filepath:
+            os.remove(list_filepath)
+    if result.returncode:
+        raise RuntimeError(f"ffmpeg failed to add audio to {output_filepath}: {result.stderr.decode(errors='replace')}")
+    logger.info(f"Wrote {output_filepath}")
+
+
+# Permits that are told apart, like the slot groups of a frame ring that tasks write to. acquire returns
+# the permit taken, or None when blocking is False and none is free.
+class PermitPool:
+    def __init__(self, permits):
+        self.free = queue.Queue()
+        for permit in permits:
+            self.free.put(permit)
+
+    def acquire(self, blocking=True):
+        try:
+            return self.free.get(block=blocking)
+        except queue.Empty:
+            return None
+
+    def release(self, permit):
+        self.free.put(permit)
+
+
+# Like pool.imap, but with at most window tasks in flight, so finished frames cannot pile up in memory
+# while the consumer is still encoding earlier ones. With permits, each task in flight also holds one
+# of them and is called with it as its last argument, which bounds the tasks of several consumers
+# sharing the pool together. A permit is released when the consumer comes back for the next result,
+# so whatever the permit stands for is free again only once the consumer is done with this one.
+def imap_window(pool, func, args, window, permits=None):
+    pending = collections.deque()
+
+    def take():
+        result, permit = pending.popleft()
+        try:
+            yield result.get()
+        finally:
+            if permits is not None:
+                permits.release(permit)
+
+    for arg in args:
+        permit = None
+        if permits is not None:
+            # Finish our own tasks instead of holding permits while waiting for one
+            permit = permits.acquire(blocking=False)
+            while permit is None and pending:
+                yield from take()
+                permit = permits.acquire(blocking=False)
+            if permit is None:
+                permit = permits.acquire()
+            arg = (*arg, permit)
+        pending.append((pool.apply_async(func, arg), permit))
+        if len(pending) >= window:
+            yield from take()
+    while pending:
+        yield from take()
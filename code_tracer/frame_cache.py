@@ -0,0 +1,142 @@
+import hashlib
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from utils import logger
+
+# Bump when create_image changes what it draws, so stale frames are not reused
+FRAME_CACHE_VERSION = 1
+# A full cache is evicted down to this share of its budget, so that it is not scanned again on every write
+EVICT_TO = 0.9
+
+# Size on disk and eviction lock of each cache directory, shared by the processes forked after the first
+# FrameCache for it was created. A FrameCache sent to a pool worker finds them here.
+shared_sizes = {}
+
+
+def get_shared_size(cache_dir):
+    if cache_dir not in shared_sizes:
+        size = multiprocessing.Value("q", get_cache_size(cache_dir), lock=False)
+        shared_sizes[cache_dir] = (size, multiprocessing.Lock())
+    return shared_sizes[cache_dir]
+
+
+# (mtime, size, filepath) of every frame in a cache directory, leaving out frames still being written
+def list_frames(cache_dir):
+    frames = []
+    for root, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if filename.endswith(".tmp"):
+                continue
+            filepath = os.path.join(root, filename)
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            frames.append((stat.st_mtime, stat.st_size, filepath))
+    return frames
+
+
+def get_cache_size(cache_dir):
+    return sum(size for _, size, _ in list_frames(cache_dir))
+
+
+# Rendered frames on disk, keyed by everything that affects how a frame looks. Frames are stored as raw
+# arrays, since encoding a PNG costs more than rendering the frame again. Reads refresh the file's
+# mtime. Writes add to the size of the cache shared by the render workers, and the write that takes it
+# over its budget evicts the least recently used frames.
+class FrameCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True, mode=0o777)
+        self.size, self.lock = get_shared_size(cache_dir)
+        with self.lock:
+            if self.size.value > self.max_bytes:
+                self.evict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["size"], state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.size, self.lock = get_shared_size(self.cache_dir)
+
+    @staticmethod
+    def get_key(content_hash, language, font_size, dimensions, style, header, max_lines, renderer):
+        key = json.dumps(
+            [
+                FRAME_CACHE_VERSION,
+                content_hash,
+                language,
+                font_size,
+                list(dimensions),
+                style,
+                header,
+                max_lines,
+                renderer,
+            ]
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get_filepath(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def get(self, key):
+        filepath = self.get_filepath(key)
+        if not os.path.exists(filepath):
+            return None
+        try:
+            image = np.load(filepath)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(filepath)
+        except OSError:
+            pass
+        return image
+
+    def put(self, key, image):
+        filepath = self.get_filepath(key)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True, mode=0o777)
+        temp_filepath = f"{filepath}.{os.getpid()}.tmp"
+        with open(temp_filepath, "wb") as f:
+            np.save(f, image)
+            size = f.tell()
+        try:
+            size -= os.path.getsize(filepath)
+        except OSError:
+            pass
+        os.replace(temp_filepath, filepath)
+        with self.lock:
+            self.size.value += size
+            if self.size.value > self.max_bytes:
+                self.evict()
+
+    # Remove the least recently used frames until the cache is down to EVICT_TO of its budget. Called with
+    # the lock held, the size is recounted from the files, as other runs may share the directory.
+    def evict(self):
+        frames = list_frames(self.cache_dir)
+        total_size = sum(size for _, size, _ in frames)
+        target_size = self.max_bytes * EVICT_TO
+        removed = 0
+        for _, size, filepath in sorted(frames):
+            if total_size <= target_size:
+                break
+            try:
+                os.remove(filepath)
+            except OSError:
+                continue
+            total_size -= size
+            removed += 1
+        self.size.value = total_size
+        if removed:
+            logger.info(f"Evicted {removed} frames from the frame cache.")
+        return removed
@@ -0,0 +1,58 @@
+import os
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+SHM_DIR = "/dev/shm"
+
+
+# Frame slots in one shared memory block. Render workers write frames into the slots and return only
+# the slot numbers, so frames are not pickled through the pool's result pipe. The parent owns the
+# block and decides which slots a task may write to. Slots are frame_size bytes, the size of the
+# largest frame, so the resolutions of a video can share one ring.
+class FrameRing:
+    def __init__(self, frame_size, slot_count):
+        self.frame_size = frame_size
+        self.slot_count = slot_count
+        self.shm = shared_memory.SharedMemory(create=True, size=frame_size * slot_count)
+        self.name = self.shm.name
+
+    def frame(self, slot, shape):
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=slot * self.frame_size)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Whether rings of the given total size fit in /dev/shm. Writing past its size would kill the worker
+# with SIGBUS instead of failing to allocate.
+def shared_memory_fits(size):
+    if not os.path.isdir(SHM_DIR):
+        return True
+    stat = os.statvfs(SHM_DIR)
+    return size <= stat.f_bavail * stat.f_frsize
+
+
+# Blocks attached in this worker process, by name
+attached_rings = {}
+
+
+def attach_ring(name):
+    if name not in attached_rings:
+        shm = shared_memory.SharedMemory(name=name)
+        # The parent unlinks the block, the worker must not have the resource tracker do it as well
+        resource_tracker.unregister(shm._name, "shared_memory")
+        attached_rings[name] = shm
+    return attached_rings[name]
+
+
+def write_frame(name, frame_size, slot, frame):
+    shm = attach_ring(name)
+    np.ndarray(frame.shape, dtype=np.uint8, buffer=shm.buf, offset=slot * frame_size)[:] = frame
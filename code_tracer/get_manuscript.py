@@ -1,18 +1,116 @@
-from dotenv import load_dotenv
-import openai
+import difflib
+import functools
+import hashlib
 import json
 import os
-import tiktoken
 
-load_dotenv()
+from utils import load_environment
+
+MANUSCRIPT_MODEL = "gpt-4-turbo-preview"
+
+
+# Chat completions from the OpenAI API
+class OpenAIBackend:
+    def __init__(self, api_key):
+        load_environment()
+        import openai
+
+        self.openai = openai
+        self.api_key = api_key
+
+    def complete(self, model, messages):
+        self.openai.api_key = self.api_key
+        return self.openai.ChatCompletion.create(model=model, messages=messages)
+
+
+# Replays a saved gpt_api_response.json instead of calling the API, to run without network access or
+# credentials in tests and CI
+class ReplayBackend:
+    def __init__(self, filepath):
+        self.filepath = os.path.expanduser(filepath)
+
+    def complete(self, model, messages):
+        with open(self.filepath, "r") as f:
+            return json.load(f)
+
+
+def get_manuscript_backend(config):
+    backend = config.get("manuscript_backend")
+    if backend == "openai":
+        return OpenAIBackend(config.get("openai_api_key"))
+    if backend == "replay":
+        return ReplayBackend(config.get("manuscript_replay_filepath"))
+    raise ValueError(f"Unknown manuscript backend: {backend}")
+
+
+# Where completions come from, so that a response replayed from a file is never used for the API or for
+# another file
+def get_manuscript_source(config):
+    backend = config.get("manuscript_backend")
+    if backend == "replay":
+        return [backend, os.path.abspath(os.path.expanduser(config.get("manuscript_replay_filepath")))]
+    return [backend]
+
+
+def get_manuscript_cache_key(source, model, context, payload):
+    key = json.dumps([source, model, context, payload], sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+# The completion for a payload, from the manuscript cache when the same model, context and payload were
+# sent to the same backend before. Cache entries are stored the way gpt_api_response.json is written.
+def get_completion(model, context, payload, config, logger):
+    messages = [
+        {"role": "system", "content": context},
+        {"role": "user", "content": json.dumps(payload)},
+    ]
+    cache_filepath = None
+    if config.get("manuscript_cache"):
+        cache_dir = os.path.join(os.path.expanduser(config.get("output_dir")), "manuscript_cache")
+        cache_filepath = os.path.join(
+            cache_dir, f"{get_manuscript_cache_key(get_manuscript_source(config), model, context, payload)}.json"
+        )
+        if not config.get("regenerate_manuscript") and os.path.exists(cache_filepath):
+            logger.info(f"Using cached manuscript response: {cache_filepath}")
+            with open(cache_filepath, "r") as f:
+                return json.load(f)
+
+    completion = get_manuscript_backend(config).complete(model, messages)
+    if cache_filepath:
+        os.makedirs(cache_dir, exist_ok=True, mode=0o777)
+        temp_filepath = f"{cache_filepath}.{os.getpid()}.tmp"
+        with open(temp_filepath, "w") as out:
+            json.dump(completion, out, indent=4)
+        os.replace(temp_filepath, cache_filepath)
+    return completion
+
+
+# Unified diff of a file from its first to its last snapshot in the payload's sessions
+def get_file_diff(filename, beginning, end, context_lines):
+    diff = difflib.unified_diff(
+        beginning.splitlines(True), end.splitlines(True), f"a/{filename}", f"b/{filename}", n=context_lines
+    )
+    return "".join(line if line.endswith("\n") else f"{line}\n" for line in diff)
 
 
 def create_payload(change_files, config, logger):
     logger.info("Creating GPT payload...")
-    changes = {
-        filename: {"beginning": values[0]["content"], "end": values[-1]["content"]}
-        for filename, values in change_files.items()
-    }
+    if config.get("payload_diffs"):
+        context_lines = config.get("payload_diff_context")
+        changes = {}
+        for filename, values in change_files.items():
+            # A file with a single snapshot has no earlier state in these sessions, so all of it is new
+            beginning = values[0]["content"] if len(values) > 1 else ""
+            diff = get_file_diff(filename, beginning, values[-1]["content"], context_lines)
+            if diff:
+                changes[filename] = {"diff": diff}
+            else:
+                logger.info(f"{filename} ends where it started, leaving it out of the GPT payload")
+    else:
+        changes = {
+            filename: {"beginning": values[0]["content"], "end": values[-1]["content"]}
+            for filename, values in change_files.items()
+        }
 
     payload = {
         "video_catch_phrase": config.get("video_catch_phrase"),
@@ -27,20 +125,102 @@ def create_payload(change_files, config, logger):
     return payload
 
 
-def get_manuscript(payload, config, logger):
-    encoding = tiktoken.encoding_for_model("gpt-4-turbo")
-    logger.info("Using GPT to generate manuscript...")
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    import tiktoken
+
+    return tiktoken.encoding_for_model("gpt-4-turbo")
+
+
+# Token counts of payload parts, kept on disk by a hash of the text so unchanged files are not encoded
+# again on the next run
+class TokenCounts:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.counts = {}
+        self.changed = False
+        if filepath and os.path.exists(filepath):
+            with open(filepath, "r") as f:
+                self.counts = json.load(f)
+
+    def count(self, text):
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if key not in self.counts:
+            self.counts[key] = len(get_encoding().encode(text))
+            self.changed = True
+        return self.counts[key]
+
+    def save(self):
+        if not self.filepath or not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.filepath), exist_ok=True, mode=0o777)
+        temp_filepath = f"{self.filepath}.{os.getpid()}.tmp"
+        with open(temp_filepath, "w") as out:
+            json.dump(self.counts, out)
+        os.replace(temp_filepath, self.filepath)
+        self.changed = False
+
+
+def get_token_counts(config):
+    return TokenCounts(os.path.join(os.path.expanduser(config.get("output_dir")), "payload_token_counts.json"))
+
+
+# How much a file changed, in changed lines of its diff or lines of its last state
+def get_change_size(file_changes):
+    if "diff" in file_changes:
+        lines = file_changes["diff"].splitlines()
+        return sum(1 for line in lines if line[:1] in "+-" and line[:3] not in ("+++", "---"))
+    return len(file_changes["end"].splitlines())
+
+
+def get_file_tokens(payload, token_counts):
+    return {
+        filename: token_counts.count(json.dumps({filename: file_changes}))
+        for filename, file_changes in payload["changes"].items()
+    }
+
+
+# Keep the files that changed the most while the payload and context fit in payload_token_budget tokens.
+# The total is the sum of the cached counts of each file on its own, which adds a pair of braces per file
+# to the encoded payload, so it errs on the side of fitting.
+def fit_payload(payload, config, logger, token_counts):
     context = open(os.path.expanduser(config.get("context_filepath")), "r").read()
-    tokens = {}
-    for filename, file_changes in payload["changes"].items():
-        tokens[filename] = len(encoding.encode(json.dumps(file_changes)))
-    encoded = encoding.encode(f"{json.dumps(payload)} {context}")
-    logger.info(f"Total tokens: {len(encoded)}")
+    budget = config.get("payload_token_budget")
+    # A token is at least one byte, so a payload whose bytes fit is not counted, which also spares loading
+    # tiktoken's encoding, downloaded on first use
+    payload_bytes = len(f"{json.dumps(payload)} {context}".encode("utf-8"))
+    if payload_bytes <= budget:
+        logger.info(f"Total tokens: at most {payload_bytes} of {budget}, {len(payload['changes'])} files")
+        return
+    base_tokens = token_counts.count(f"{json.dumps({**payload, 'changes': {}})} {context}")
+    tokens = get_file_tokens(payload, token_counts)
+    by_size = sorted(
+        payload["changes"], key=lambda filename: get_change_size(payload["changes"][filename]), reverse=True
+    )
+
+    total = base_tokens
+    kept = []
+    for filename in by_size:
+        if total + tokens[filename] <= budget:
+            kept.append(filename)
+            total += tokens[filename]
+        else:
+            logger.info(f"Leaving {filename} ({tokens[filename]} tokens) out of the GPT payload")
+    changes = payload["changes"]
+    payload["changes"] = {filename: changes[filename] for filename in changes if filename in kept}
+    logger.info(f"Total tokens: about {total} of {budget}, {len(kept)} of {len(changes)} files")
+
+
+# Ask which files to leave out of the payload. Reads from the terminal, so it has to run in the
+# foreground.
+def choose_payload_files(payload, config, logger, token_counts):
+    context = open(os.path.expanduser(config.get("context_filepath")), "r").read()
+    base_tokens = token_counts.count(f"{json.dumps({**payload, 'changes': {}})} {context}")
+    tokens = get_file_tokens(payload, token_counts)
 
     reducing = True
     while reducing:
-        encoded = encoding.encode(f"{json.dumps(payload)} {context}")
-        logger.info(f"Total tokens: {len(encoded)}")
+        logger.info(f"Total tokens: about {base_tokens + sum(tokens.values())}")
         print("Would you like to remove any files from the GPT payload?")
         for i, (filename, token_count) in enumerate(tokens.items()):
             print(f"{i + 1}. {filename} ({token_count} tokens)")
@@ -59,32 +239,41 @@ def get_manuscript(payload, config, logger):
         except (ValueError, IndexError):
             print("Invalid selection.")
 
-    encoded = encoding.encode(f"{json.dumps(payload)} {context}")
-    logger.info(f"Total tokens: {len(encoded)}")
-
-    model = "gpt-4-turbo-preview"
-    openai.api_key = config.get("openai_api_key")
-    completion = openai.ChatCompletion.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": context},
-            {"role": "user", "content": json.dumps(payload)},
-        ],
-    )
+    logger.info(f"Total tokens: about {base_tokens + sum(tokens.values())}")
+
+
+# Fit the payload to the token budget, then with payload_interactive ask which other files to leave out.
+# A replayed response does not depend on the payload, so it is not fitted and replays need no network.
+def reduce_payload(payload, config, logger):
+    token_counts = get_token_counts(config)
+    if config.get("manuscript_backend") != "replay":
+        fit_payload(payload, config, logger, token_counts)
+    if config.get("payload_interactive"):
+        choose_payload_files(payload, config, logger, token_counts)
+    token_counts.save()
+
+
+def get_manuscript(payload, config, logger, reduce=True):
+    if reduce:
+        reduce_payload(payload, config, logger)
+    logger.info("Using GPT to generate manuscript...")
+    context = open(os.path.expanduser(config.get("context_filepath")), "r").read()
+
+    completion = get_completion(MANUSCRIPT_MODEL, context, payload, config, logger)
 
     output_location = config.get("video_output_dir")
     gpt_api_response_filepath = os.path.join(output_location, 'gpt_api_response.json')
     with open(gpt_api_response_filepath, "w") as out:
         json.dump(completion, out, indent=4)
         logger.info(f'GPT api response written to file: {gpt_api_response_filepath}')
-    content = completion.choices[0].message.content
+    content = completion["choices"][0]["message"]["content"]
     gpt_content_filepath = os.path.join(output_location, 'gpt_content.json')
     response_json = json.loads(content)
     with open(gpt_content_filepath, "w") as out:
         json.dump(response_json, out, indent=4)
         logger.info(f'GPT message content written to file: {gpt_content_filepath}')
-    config.set("total_progress", response_json["total_progress"])
-    config.write()
+    # Saved once the video is written, so a rerun after a failure sends the same payload and hits the cache
+    config.set("total_progress", response_json["total_progress"], local=True)
 
     manuscript = response_json["manuscript"]
     manuscript = manuscript.replace("`", "'")
@@ -0,0 +1,95 @@
+import threading
+
+import numpy as np
+from PIL import Image
+
+from utils import logger
+
+# When the frames have more colours than a GIF palette holds, the palette is quantized from every
+# PALETTE_STEP-th pixel along each axis of at most PALETTE_FRAMES frames, spread over the GIF
+PALETTE_SIZE = 256
+PALETTE_STEP = 4
+PALETTE_FRAMES = 32
+
+
+def pack_colors(frame):
+    frame = frame.astype(np.uint32)
+    return (frame[..., 0] << 16) | (frame[..., 1] << 8) | frame[..., 2]
+
+
+# Frames of a GIF, collected in order and written with one palette for the whole GIF. A frame that is
+# identical to the one before it only makes that frame's delay longer.
+class GifWriter:
+    def __init__(self, output_filepath, loop=0):
+        self.output_filepath = output_filepath
+        self.loop = loop
+        self.frames = []
+        self.durations = []
+        # Which of the 2**24 RGB colours appear in any frame
+        self.colors = np.zeros(1 << 24, dtype=bool)
+
+    def add(self, frame, duration):
+        if self.frames and (self.frames[-1] is frame or np.array_equal(self.frames[-1], frame)):
+            self.durations[-1] += duration
+            return
+        self.frames.append(frame)
+        self.durations.append(duration)
+        self.colors[pack_colors(frame)] = True
+
+    # Code frames are a few greys and syntax colours, which usually fit the palette exactly. Returns the
+    # palette image and, for an exact palette, a lookup from packed colour to palette index.
+    def get_palette(self):
+        colors = np.flatnonzero(self.colors)
+        if len(colors) <= PALETTE_SIZE:
+            palette = np.stack([colors >> 16, (colors >> 8) & 0xFF, colors & 0xFF], axis=-1).astype(np.uint8)
+            palette_image = Image.new("P", (1, 1))
+            palette_image.putpalette(palette.tobytes())
+            lookup = np.zeros(1 << 24, dtype=np.uint8)
+            lookup[colors] = np.arange(len(colors))
+            return palette_image, lookup
+        step = max(len(self.frames) // PALETTE_FRAMES, 1)
+        samples = np.concatenate([frame[::PALETTE_STEP, ::PALETTE_STEP] for frame in self.frames[::step]])
+        palette_image = Image.fromarray(samples).quantize(
+            colors=PALETTE_SIZE, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE
+        )
+        return palette_image, None
+
+    def close(self):
+        if not self.frames:
+            return
+        palette_image, lookup = self.get_palette()
+        images = []
+        while self.frames:
+            frame = self.frames.pop(0)
+            if lookup is None:
+                image = Image.fromarray(frame).quantize(palette=palette_image, dither=Image.Dither.NONE)
+            else:
+                image = Image.fromarray(lookup[pack_colors(frame)], mode="P")
+                image.putpalette(palette_image.getpalette())
+            images.append(image)
+        images[0].save(
+            self.output_filepath,
+            save_all=True,
+            append_images=images[1:],
+            duration=[round(duration) for duration in self.durations],
+            loop=self.loop,
+        )
+        logger.info(f"Wrote {self.output_filepath} with {len(images)} distinct frames")
+
+
+# A GifWriter fed by threads that may deliver its frames out of order, like the encoders of the segments
+# of a video. A frame is added once the frames before it have been.
+class OrderedGifWriter(GifWriter):
+    def __init__(self, output_filepath, duration, loop=0):
+        super().__init__(output_filepath, loop)
+        self.duration = duration
+        self.pending = {}
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def add_at(self, index, frame):
+        with self.lock:
+            self.pending[index] = frame
+            while self.next_index in self.pending:
+                self.add(self.pending.pop(self.next_index), self.duration)
+                self.next_index += 1
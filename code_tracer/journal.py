@@ -0,0 +1,234 @@
+import glob
+import json
+import os
+import struct
+import threading
+import zlib
+
+from utils import logger
+
+# Each record is framed as (payload length, flags) followed by the JSON payload. Blob payloads are a
+# JSON header line followed by the raw content, which avoids escaping whole files as JSON strings.
+RECORD_HEADER = struct.Struct(">IB")
+FLAG_COMPRESSED = 1
+FLAG_BLOB = 2
+
+
+def get_segment_filepath(journal_dir, segment):
+    return os.path.join(journal_dir, f"{segment:06d}.log")
+
+
+def get_index_filepath(journal_dir, segment):
+    return os.path.join(journal_dir, f"{segment:06d}.idx")
+
+
+def list_segments(journal_dir):
+    filepaths = glob.glob(os.path.join(journal_dir, "*.log"))
+    return sorted(int(os.path.basename(filepath)[:-4]) for filepath in filepaths)
+
+
+def read_index(journal_dir, segment):
+    index_filepath = get_index_filepath(journal_dir, segment)
+    if not os.path.exists(index_filepath):
+        return []
+    entries = []
+    with open(index_filepath, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A torn final line from a crash, Journal._recover rewrites it from the segment
+                break
+    return entries
+
+
+def encode_record(record, compression):
+    flags = 0
+    if record.get("type") == "blob":
+        header = {key: value for key, value in record.items() if key != "content"}
+        payload = json.dumps(header).encode("utf-8") + b"\n" + record["content"].encode("utf-8")
+        flags |= FLAG_BLOB
+    else:
+        payload = json.dumps(record).encode("utf-8")
+    if compression:
+        payload = zlib.compress(payload)
+        flags |= FLAG_COMPRESSED
+    return payload, flags
+
+
+def decode_record(payload, flags):
+    if flags & FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+    if flags & FLAG_BLOB:
+        header, _, content = payload.partition(b"\n")
+        record = json.loads(header)
+        record["content"] = content.decode("utf-8")
+        return record
+    return json.loads(payload)
+
+
+def read_record(journal_dir, segment, offset, length):
+    with open(get_segment_filepath(journal_dir, segment), "rb") as f:
+        f.seek(offset)
+        _, flags = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        return decode_record(f.read(length), flags)
+
+
+# Read records at the given locations, one open per segment, returned in the order given
+def read_records(journal_dir, locations):
+    records = [None] * len(locations)
+    by_segment = {}
+    for position, location in enumerate(locations):
+        by_segment.setdefault(location["segment"], []).append((location["offset"], location["length"], position))
+    for segment, segment_locations in by_segment.items():
+        with open(get_segment_filepath(journal_dir, segment), "rb") as f:
+            for offset, length, position in sorted(segment_locations):
+                f.seek(offset)
+                _, flags = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                records[position] = decode_record(f.read(length), flags)
+    return records
+
+
+# Yield every record in append order. Readers never modify the journal, so this is safe to run
+# while the watcher appends; an incomplete trailing record is simply not returned yet.
+def iter_records(journal_dir):
+    for segment in list_segments(journal_dir):
+        with open(get_segment_filepath(journal_dir, segment), "rb") as f:
+            data = f.read()
+        position = 0
+        while position + RECORD_HEADER.size <= len(data):
+            length, flags = RECORD_HEADER.unpack_from(data, position)
+            position += RECORD_HEADER.size
+            if position + length > len(data):
+                break
+            yield decode_record(data[position : position + length], flags)
+            position += length
+
+
+class Journal:
+    def __init__(self, journal_dir, compression=True, segment_size=64 * 1024 * 1024, index=None):
+        self.journal_dir = journal_dir
+        self.index = index
+        self.compression = compression
+        self.segment_size = segment_size
+        self.blob_hashes = set()
+        self.segment_file = None
+        self.index_file = None
+        # Snapshot writer threads share one journal
+        self.lock = threading.RLock()
+        os.makedirs(journal_dir, exist_ok=True, mode=0o777)
+
+        segments = list_segments(journal_dir)
+        for segment in segments:
+            for entry in read_index(journal_dir, segment):
+                if entry["type"] == "blob":
+                    self.blob_hashes.add(entry["hash"])
+        self.segment = segments[-1] if segments else 1
+        self._recover(self.segment)
+
+    # Bring the index of the active segment back in line with its data after an interrupted append
+    def _recover(self, segment):
+        segment_filepath = get_segment_filepath(self.journal_dir, segment)
+        if not os.path.exists(segment_filepath):
+            return
+        entries = read_index(self.journal_dir, segment)
+        end = entries[-1]["offset"] + RECORD_HEADER.size + entries[-1]["length"] if entries else 0
+        if end == os.path.getsize(segment_filepath):
+            return
+
+        logger.warning(f"Recovering journal segment {segment_filepath}...")
+        with open(segment_filepath, "rb") as f:
+            f.seek(end)
+            while True:
+                offset = f.tell()
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, flags = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                entry = self._index_entry(decode_record(payload, flags), offset, length)
+                if entry["type"] == "blob":
+                    self.blob_hashes.add(entry["hash"])
+                entries.append(entry)
+                end = f.tell()
+        # Drop a partially written trailing record and rewrite the index
+        with open(segment_filepath, "r+b") as f:
+            f.truncate(end)
+        with open(get_index_filepath(self.journal_dir, segment), "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+
+    @staticmethod
+    def _index_entry(record, offset, length):
+        entry = {"offset": offset, "length": length, "type": record.get("type", "snapshot")}
+        if entry["type"] == "blob":
+            entry["hash"] = record["hash"]
+        else:
+            for key in ("timestamp", "filepath", "session", "content_hash", "base_hash", "size"):
+                entry[key] = record.get(key)
+        return entry
+
+    def _open_segment(self):
+        if self.segment_file and self.segment_file.tell() < self.segment_size:
+            return
+        if self.segment_file:
+            self._close_segment()
+            self.segment += 1
+        self.segment_file = open(get_segment_filepath(self.journal_dir, self.segment), "ab")
+        self.index_file = open(get_index_filepath(self.journal_dir, self.segment), "a", encoding="utf-8")
+
+    # Append a record, returning (segment, offset, length, bytes written)
+    def append(self, record):
+        payload, flags = encode_record(record, self.compression)
+        with self.lock:
+            return self._append(record, payload, flags)
+
+    def _append(self, record, payload, flags):
+        self._open_segment()
+        offset = self.segment_file.tell()
+        self.segment_file.write(RECORD_HEADER.pack(len(payload), flags) + payload)
+        self.segment_file.flush()
+        entry = self._index_entry(record, offset, len(payload))
+        entry_line = json.dumps(entry) + "\n"
+        self.index_file.write(entry_line)
+        self.index_file.flush()
+        if self.index:
+            self.index.add_entries(self.segment, [entry], self.index_file.tell())
+        if entry["type"] == "blob":
+            self.blob_hashes.add(record["hash"])
+        return self.segment, offset, len(payload), RECORD_HEADER.size + len(payload) + len(entry_line)
+
+    # Store content once per hash, returning the number of bytes written (0 if it already existed)
+    def write_blob(self, content_hash, content):
+        with self.lock:
+            if content_hash in self.blob_hashes:
+                return 0
+            return self.append({"type": "blob", "hash": content_hash, "content": content})[3]
+
+    def sync(self):
+        with self.lock:
+            for f in (self.segment_file, self.index_file):
+                if f:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def _close_segment(self):
+        self.sync()
+        for f in (self.segment_file, self.index_file):
+            if f:
+                f.close()
+        self.segment_file = None
+        self.index_file = None
+
+    def close(self):
+        with self.lock:
+            self._close_segment()
+        if self.index:
+            self.index.close()
+            self.index = None
+
+
+def get_journal_dir(output_dir):
+    return os.path.join(output_dir, "journal")
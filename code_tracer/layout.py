@@ -0,0 +1,64 @@
+import functools
+import math
+
+from PIL import ImageFont
+from pygments.formatters.img import FontManager
+
+# Geometry of the ImageFormatter used by highlight_code (see pygments.formatters.img)
+IMAGE_PAD = 10
+LINE_PAD = 2
+LINE_NUMBER_CHARS = 4
+LINE_NUMBER_PAD = 6
+TAB_SIZE = 4
+MAX_FONT_SIZE = 500
+
+
+@functools.lru_cache(maxsize=None)
+def get_font_path():
+    return FontManager("", 14).fonts["NORMAL"].path
+
+
+# ImageFormatter sizes the line number column and the line height from the ink box of "M", while
+# text advances by the font's own advance width (which can be a pixel narrower)
+@functools.lru_cache(maxsize=None)
+def get_cell_size(font_size):
+    font = ImageFont.truetype(get_font_path(), int(font_size))
+    fontw, fonth = font.getbbox("M")[2:4]
+    return fontw, fonth, font.getlength("M")
+
+
+# Lines and longest tab-expanded line of the text a snapshot is rendered from
+def measure_text(text):
+    lines = text.split("\n")
+    # The lexer adds a final newline, and ImageFormatter counts newlines
+    line_count = len(lines) - 1 if text.endswith("\n") else len(lines)
+    max_line_length = max(len(line.expandtabs(TAB_SIZE)) for line in lines)
+    return line_count, max_line_length
+
+
+def get_code_size(line_count, max_line_length, font_size):
+    fontw, fonth, advance = get_cell_size(font_size)
+    line_number_width = fontw * LINE_NUMBER_CHARS + LINE_NUMBER_PAD * 2
+    width = 2 * IMAGE_PAD + line_number_width + math.ceil(max_line_length * advance)
+    height = line_count * (fonth + LINE_PAD) + 2 * IMAGE_PAD
+    return width, height
+
+
+# Whether code of the given size, split into columns of max_code_height, is narrower than max_width
+def code_fits(code_size, max_code_height, max_width):
+    width, height = code_size
+    return math.ceil(height / max_code_height) * width < max_width
+
+
+# Largest font size below the given upper bound at which the text fits, 0 if none does. Every step of
+# the binary search is a lookup of the cell size instead of a render.
+def fit_font_size(line_count, max_line_length, max_code_height, max_width, high=MAX_FONT_SIZE):
+    low = 0
+    high = math.ceil(high)
+    while high - low > 1:
+        font_size = (high + low) // 2
+        if code_fits(get_code_size(line_count, max_line_length, font_size), max_code_height, max_width):
+            low = font_size
+        else:
+            high = font_size
+    return low
@@ -0,0 +1,390 @@
+import bisect
+import functools
+import re
+
+from pygments.lexer import ExtendedRegexLexer, RegexLexer
+from pygments.lexers import get_lexer_by_name
+from pygments.token import Error, Whitespace, _TokenType
+
+from storage import hash_content
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+
+@functools.lru_cache(maxsize=None)
+def get_lexer(language):
+    lexer = get_lexer_by_name(language)
+    lexer.stripnl = False
+    return lexer
+
+
+# Whether tokens can be produced by the regex loop below, which is RegexLexer.get_tokens_unprocessed
+# with the state stack recorded at line starts
+def supports_incremental(lexer):
+    return (
+        isinstance(lexer, RegexLexer)
+        and not isinstance(lexer, ExtendedRegexLexer)
+        and type(lexer).get_tokens_unprocessed is RegexLexer.get_tokens_unprocessed
+        and not lexer.filters
+    )
+
+
+# What Lexer.get_tokens does to the text before lexing it
+def prepare_text(lexer, text):
+    if text.startswith("\ufeff"):
+        text = text[1:]
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    if lexer.stripall:
+        text = text.strip()
+    elif lexer.stripnl:
+        text = text.strip("\n")
+    if lexer.tabsize > 0:
+        text = text.expandtabs(lexer.tabsize)
+    if lexer.ensurenl and not text.endswith("\n"):
+        text += "\n"
+    return text
+
+
+def common_prefix_length(a, b):
+    length = min(len(a), len(b))
+    low, high = 0, length
+    # Compare in halving chunks, string comparison is done in C
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_suffix_length(a, b, limit):
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle : len(a) - low] == b[len(b) - middle : len(b) - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+ROOT_STACK = ("root",)
+NEWLINE = ord("\n")
+REPEATS = tuple(
+    getattr(sre_constants, name)
+    for name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+    if hasattr(sre_constants, name)
+)
+NEWLINE_CATEGORIES = {
+    sre_constants.CATEGORY_SPACE,
+    sre_constants.CATEGORY_NOT_DIGIT,
+    sre_constants.CATEGORY_NOT_WORD,
+    sre_constants.CATEGORY_LINEBREAK,
+}
+CATEGORY_CLASSES = {
+    sre_constants.CATEGORY_DIGIT: r"\d",
+    sre_constants.CATEGORY_NOT_DIGIT: r"\D",
+    sre_constants.CATEGORY_SPACE: r"\s",
+    sre_constants.CATEGORY_NOT_SPACE: r"\S",
+    sre_constants.CATEGORY_WORD: r"\w",
+    sre_constants.CATEGORY_NOT_WORD: r"\W",
+    sre_constants.CATEGORY_LINEBREAK: r"\n",
+}
+LINE_START = (sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING)
+ANYWHERE = re.compile("").match
+
+
+# Whether a parsed regex can read a newline, in what it matches or looks around at. Anything it does not
+# know about counts as reading one.
+def reads_newline(items, flags):
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            if av == NEWLINE:
+                return True
+        elif op is sre_constants.NOT_LITERAL:
+            if av != NEWLINE:
+                return True
+        elif op is sre_constants.ANY:
+            if flags & re.DOTALL:
+                return True
+        elif op is sre_constants.IN:
+            if in_set(av, NEWLINE):
+                return True
+        elif op is sre_constants.AT:
+            continue
+        elif op is sre_constants.SUBPATTERN:
+            if reads_newline(av[-1], (flags | av[1]) & ~av[2]):
+                return True
+        elif op in REPEATS:
+            if reads_newline(av[2], flags):
+                return True
+        elif op is sre_constants.BRANCH:
+            if any(reads_newline(branch, flags) for branch in av[1]):
+                return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if reads_newline(av[1], flags):
+                return True
+        else:
+            return True
+    return False
+
+
+def in_set(items, char):
+    negate = False
+    found = False
+    for op, av in items:
+        if op is sre_constants.NEGATE:
+            negate = True
+        elif op is sre_constants.LITERAL:
+            found = found or av == char
+        elif op is sre_constants.RANGE:
+            found = found or av[0] <= char <= av[1]
+        elif op is sre_constants.CATEGORY and av in CATEGORY_CLASSES:
+            found = found or av in NEWLINE_CATEGORIES
+        else:
+            return True
+    return found != negate
+
+
+# Character classes of the characters a match of a parsed regex can start with, and whether it can match
+# the empty string. The classes are None when it can start with anything.
+def first_classes(items, flags):
+    classes = []
+    for op, av in items:
+        if op is sre_constants.AT:
+            continue
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            # A lookaround that can read past the line is tried before the first character is matched
+            if reads_newline(av[1], flags):
+                return None, False
+            continue
+        if op is sre_constants.LITERAL:
+            return classes + [re.escape(chr(av))], False
+        if op is sre_constants.IN:
+            char_class = set_class(av)
+            return (None if char_class is None else classes + [char_class]), False
+        if op is sre_constants.SUBPATTERN:
+            if av[1] & ~flags & re.IGNORECASE:
+                return None, False
+            sub_classes, nullable = first_classes(av[-1], flags)
+        elif op in REPEATS:
+            sub_classes, nullable = first_classes(av[2], flags)
+            nullable = nullable or av[0] == 0
+        elif op is sre_constants.BRANCH:
+            sub_classes, nullable = [], False
+            for branch in av[1]:
+                branch_classes, branch_nullable = first_classes(branch, flags)
+                if branch_classes is None:
+                    return None, False
+                sub_classes += branch_classes
+                nullable = nullable or branch_nullable
+        else:
+            return None, False
+        if sub_classes is None:
+            return None, False
+        classes += sub_classes
+        if not nullable:
+            return classes, False
+    return classes, True
+
+
+def set_class(items):
+    parts = []
+    for op, av in items:
+        if op is sre_constants.NEGATE:
+            parts.insert(0, "^")
+        elif op is sre_constants.LITERAL:
+            parts.append(re.escape(chr(av)))
+        elif op is sre_constants.RANGE:
+            parts.append(f"{re.escape(chr(av[0]))}-{re.escape(chr(av[1]))}")
+        elif op is sre_constants.CATEGORY and av in CATEGORY_CLASSES:
+            parts.append(CATEGORY_CLASSES[av])
+        else:
+            return None
+    return f"[{''.join(parts)}]"
+
+
+# A match function that is true at the positions where a failed match of the regex may have read past the
+# end of the line, or None if it never reads past a line end. A regex that cannot read a newline stops at
+# the end of the line, and one that cannot start with the character at a position stops there.
+def get_watch(pattern):
+    items = sre_parse.parse(pattern.pattern, pattern.flags)
+    if not reads_newline(items, pattern.flags):
+        return None
+    classes, nullable = first_classes(items, pattern.flags)
+    line_start = len(items) > 0 and items[0][0] is sre_constants.AT and items[0][1] in LINE_START
+    if classes is None or nullable:
+        if not line_start:
+            return ANYWHERE
+        return re.compile("^", re.MULTILINE).match
+    watch = f"(?:{'|'.join(classes)})"
+    if line_start:
+        watch = f"^{watch}"
+    return re.compile(watch, re.MULTILINE | (pattern.flags & (re.IGNORECASE | re.ASCII))).match
+
+
+# The rules of each state of a lexer, with the watch function of each rule
+@functools.lru_cache(maxsize=None)
+def get_watched_rules(lexer):
+    return {
+        state: [(rexmatch, action, new_state, get_watch(rexmatch.__self__)) for rexmatch, action, new_state in rules]
+        for state, rules in lexer._tokens.items()
+    }
+
+
+# Tokens of a text and the lexer state at line starts between tokens, as (position, token count,
+# state stack, attempt count) checkpoints. Lexing can restart from any checkpoint. Attempts are the
+# (position, match function) of the failed matches that may have read past the end of their line.
+class LexResult:
+    def __init__(self, text, tokens, checkpoints=None, attempts=None):
+        self.text = text
+        self.tokens = tokens
+        self.checkpoints = checkpoints
+        self.attempts = attempts
+        self.positions = [checkpoint[0] for checkpoint in checkpoints] if checkpoints else None
+
+
+# Lex text with a RegexLexer, reusing the tokens of a previous version of the same file. Lexing
+# restarts from a root state checkpoint at least one before the first changed line, as a regex at the
+# end of the line before a change may have looked ahead into it. A multi-line construct is lexed again
+# from where it was entered, as a change inside it, like closing a string, can change how it starts.
+# A failed match before the checkpoint that matches now, like a comment regex that did not find its
+# end before, moves the restart back to it. Once the lexer is a full line into the unchanged end of the
+# file and at a checkpoint with the same state stack as before, the previous tokens are reused for the
+# rest of the file. Returns the result and how many characters were lexed.
+def lex(lexer, text, previous=None):
+    tokens = []
+    attempts = []
+    checkpoints = [(0, 0, ROOT_STACK, 0)]
+    resync_start = len(text) + 1
+    shift = 0
+    old_positions = {}
+    if previous is not None and previous.checkpoints:
+        prefix = common_prefix_length(previous.text, text)
+        suffix = common_suffix_length(previous.text, text, min(len(previous.text), len(text)) - prefix)
+        index = max(bisect.bisect_right(previous.positions, prefix) - 2, 0)
+        for position, rexmatch in previous.attempts[: previous.checkpoints[index][3]]:
+            if rexmatch(text, position):
+                index = bisect.bisect_right(previous.positions, position) - 1
+                break
+        while previous.checkpoints[index][2] != ROOT_STACK:
+            index -= 1
+        _, count, _, attempt_count = previous.checkpoints[index]
+        tokens = previous.tokens[:count]
+        attempts = previous.attempts[:attempt_count]
+        checkpoints = previous.checkpoints[: index + 1]
+        resync_start = len(text) - suffix
+        shift = len(text) - len(previous.text)
+        old_positions = {position: i for i, position in enumerate(previous.positions)}
+
+    start, _, stack, _ = checkpoints[-1]
+    pos = start
+    tokendefs = get_watched_rules(lexer)
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+    append = tokens.append
+    while 1:
+        for rexmatch, action, new_state, watch in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        append((action, m.group()))
+                    else:
+                        tokens.extend((token_type, value) for _, token_type, value in action(lexer, m))
+                pos = m.end()
+                if new_state is not None:
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == "#pop":
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif state == "#push":
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        if abs(new_state) >= len(statestack):
+                            del statestack[1:]
+                        else:
+                            del statestack[new_state:]
+                    elif new_state == "#push":
+                        statestack.append(statestack[-1])
+                    else:
+                        raise ValueError(f"Wrong state definition: {new_state!r}")
+                    statetokens = tokendefs[statestack[-1]]
+                break
+            if watch is not None and watch(text, pos):
+                attempts.append((pos, rexmatch))
+        else:
+            if pos >= len(text):
+                break
+            if text[pos] == "\n":
+                statestack = ["root"]
+                statetokens = tokendefs["root"]
+                append((Whitespace, "\n"))
+            else:
+                append((Error, text[pos]))
+            pos += 1
+
+        if pos > checkpoints[-1][0] and text[pos - 1] == "\n":
+            checkpoint = (pos, len(tokens), tuple(statestack), len(attempts))
+            if checkpoints[-1][0] >= resync_start and pos - shift in old_positions:
+                index = old_positions[pos - shift]
+                old_pos, old_count, old_stack, old_attempt_count = previous.checkpoints[index]
+                if old_stack == checkpoint[2]:
+                    offset = len(tokens) - old_count
+                    attempt_offset = len(attempts) - old_attempt_count
+                    tokens.extend(previous.tokens[old_count:])
+                    attempts.extend(
+                        (position + shift, rexmatch) for position, rexmatch in previous.attempts[old_attempt_count:]
+                    )
+                    checkpoints.extend(
+                        (position + shift, count + offset, stack, attempt_count + attempt_offset)
+                        for position, count, stack, attempt_count in previous.checkpoints[index:]
+                    )
+                    return LexResult(text, tokens, checkpoints, attempts), pos - start
+            checkpoints.append(checkpoint)
+
+    return LexResult(text, tokens, checkpoints, attempts), pos - start
+
+
+# Tokens of every snapshot rendered in a run, keyed by language and content, so a snapshot is lexed
+# once for all resolutions and the font size fitting. Each file's last lexed version is kept to lex
+# the next snapshot of it incrementally.
+class TokenCache:
+    def __init__(self):
+        self.tokens = {}
+        self.latest = {}
+        self.hits = 0
+        self.misses = 0
+        self.total_chars = 0
+        self.lexed_chars = 0
+
+    def get_tokens(self, filepath, language, text):
+        key = (language, hash_content(text))
+        if key in self.tokens:
+            self.hits += 1
+            return self.tokens[key]
+        self.misses += 1
+        lexer = get_lexer(language)
+        if supports_incremental(lexer):
+            result, lexed_chars = lex(lexer, prepare_text(lexer, text), self.latest.get((filepath, language)))
+            self.latest[(filepath, language)] = result
+            tokens = result.tokens
+        else:
+            tokens = list(lexer.get_tokens(text))
+            lexed_chars = len(text)
+        self.total_chars += len(text)
+        self.lexed_chars += lexed_chars
+        self.tokens[key] = tokens
+        return tokens
+
+
+token_cache = TokenCache()
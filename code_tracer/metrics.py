@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import time
+
+from utils import logger
+
+PREFIX = "code_tracer_"
+
+
+# Counters, gauges and timing summaries for the watcher, shared by the watch loop and the writer
+# threads. Gauges can also be functions that are called whenever the metrics are read.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            summary = self.summaries.setdefault(name, {"count": 0, "sum": 0.0, "last": 0.0, "max": 0.0})
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["last"] = value
+            summary["max"] = max(summary["max"], value)
+
+    def snapshot(self):
+        with self.lock:
+            gauges = dict(self.gauges)
+            counters = dict(self.counters)
+            summaries = {name: dict(summary) for name, summary in self.summaries.items()}
+        for name, value in gauges.items():
+            if callable(value):
+                gauges[name] = value()
+        for summary in summaries.values():
+            summary["avg"] = summary["sum"] / summary["count"]
+        return {
+            "updated": time.time(),
+            "uptime_seconds": time.time() - self.start_time,
+            "counters": counters,
+            "gauges": gauges,
+            "summaries": summaries,
+        }
+
+    # Prometheus text exposition format
+    def to_prometheus(self):
+        stats = self.snapshot()
+        lines = [
+            f"# TYPE {PREFIX}uptime_seconds gauge",
+            f"{PREFIX}uptime_seconds {stats['uptime_seconds']:.3f}",
+        ]
+        for name, value in sorted(stats["counters"].items()):
+            lines += [f"# TYPE {PREFIX}{name} counter", f"{PREFIX}{name} {value}"]
+        for name, value in sorted(stats["gauges"].items()):
+            lines += [f"# TYPE {PREFIX}{name} gauge", f"{PREFIX}{name} {value}"]
+        for name, summary in sorted(stats["summaries"].items()):
+            lines += [
+                f"# TYPE {PREFIX}{name} summary",
+                f"{PREFIX}{name}_sum {summary['sum']:.6f}",
+                f"{PREFIX}{name}_count {summary['count']}",
+                f"# TYPE {PREFIX}{name}_last gauge",
+                f"{PREFIX}{name}_last {summary['last']:.6f}",
+                f"# TYPE {PREFIX}{name}_max gauge",
+                f"{PREFIX}{name}_max {summary['max']:.6f}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write_stats(self, filepath):
+        temp_filepath = f"{filepath}.tmp"
+        with open(temp_filepath, "w") as f:
+            json.dump(self.snapshot(), f, indent=4)
+        os.replace(temp_filepath, filepath)
+
+    # Serve the metrics on localhost from a background thread, returning the server
+    def serve(self, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Metrics request: {format % args}")
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info(f"Serving metrics on http://127.0.0.1:{server.server_address[1]}/metrics")
+        return server
+
+
+metrics = Metrics()
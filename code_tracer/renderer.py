@@ -0,0 +1,251 @@
+import functools
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+from pygments.formatters.img import FontManager
+
+from layout import IMAGE_PAD, LINE_NUMBER_CHARS, LINE_NUMBER_PAD, LINE_PAD, TAB_SIZE
+from lexing import get_lexer
+
+# Line number colours of the ImageFormatter options used by highlight_code
+LINE_NUMBER_FG = "#ffffff"
+LINE_NUMBER_BG = "#000000"
+
+
+def div255(values):
+    # Pillow's rounded division by 255
+    values = values + 128
+    return (values + (values >> 8)) >> 8
+
+
+def font_variant(style):
+    if style["bold"] and style["italic"]:
+        return "BOLDITALIC"
+    if style["bold"]:
+        return "BOLD"
+    if style["italic"]:
+        return "ITALIC"
+    return "NORMAL"
+
+
+# Glyph coverage masks of one font size, rasterized once and composited into token masks the way
+# FreeType output is combined by Pillow when it draws a whole string
+class GlyphAtlas:
+    def __init__(self, font_size):
+        font_manager = FontManager("", font_size)
+        self.fonts = font_manager.fonts
+        self.fontw, self.fonth = font_manager.get_char_size()
+        self.glyphs = {}
+        self.masks = {}
+        self.widths = {}
+
+    def glyph(self, variant, char):
+        key = (variant, char)
+        if key not in self.glyphs:
+            font = self.fonts[variant]
+            advance = font.getlength(char)
+            self.glyphs[key] = (*rasterize(font, char), advance if advance == int(advance) else None)
+        return self.glyphs[key]
+
+    # Width ImageFormatter advances by after drawing text
+    def text_width(self, text):
+        if text not in self.widths:
+            self.widths[text] = self.fonts["NORMAL"].getbbox(text)[2]
+        return self.widths[text]
+
+    # Coverage mask of a token and its offset from the drawing position, None for blank text
+    def text_mask(self, variant, text):
+        key = (variant, text)
+        if key in self.masks:
+            return self.masks[key]
+        glyphs = []
+        pen = 0
+        for char in text:
+            mask, offset_x, offset_y, advance = self.glyph(variant, char)
+            if advance is None:
+                # Fractional advances do not line up with whole pixels, let Pillow draw the string
+                glyphs = [(*rasterize(self.fonts[variant], text), 0)]
+                break
+            glyphs.append((mask, pen + offset_x, offset_y, advance))
+            pen += int(advance)
+        glyphs = [glyph for glyph in glyphs if glyph[0].any()]
+        if not glyphs:
+            self.masks[key] = None
+            return None
+
+        left = min(x for _, x, _, _ in glyphs)
+        top = min(y for _, _, y, _ in glyphs)
+        right = max(x + mask.shape[1] for mask, x, _, _ in glyphs)
+        bottom = max(y + mask.shape[0] for mask, _, y, _ in glyphs)
+        combined = np.zeros((bottom - top, right - left), dtype=np.int32)
+        for mask, x, y, _ in glyphs:
+            region = combined[y - top : y - top + mask.shape[0], x - left : x - left + mask.shape[1]]
+            # Overlapping coverage adds up like a screen blend
+            region += mask - div255(region * mask)
+        self.masks[key] = (combined, left, top)
+        return self.masks[key]
+
+
+def rasterize(font, text):
+    mask, (offset_x, offset_y) = font.getmask2(text, mode="L")
+    image = Image.new("L", (max(mask.size[0], 1), max(mask.size[1], 1)))
+    ImageDraw.Draw(image).text((-offset_x, -offset_y), text, font=font, fill=255)
+    return np.asarray(image, dtype=np.int32), offset_x, offset_y
+
+
+@functools.lru_cache(maxsize=8)
+def get_atlas(font_size):
+    return GlyphAtlas(int(font_size))
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_styles(style):
+    return dict(style)
+
+
+# Blend a solid colour into image through a coverage mask, clipped to the image
+def draw_mask(image, mask_info, x, y, color):
+    mask, offset_x, offset_y = mask_info
+    x += offset_x
+    y += offset_y
+    height, width = image.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + mask.shape[1], width), min(y + mask.shape[0], height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    alpha = mask[y0 - y : y1 - y, x0 - x : x1 - x, None]
+    region = image[y0:y1, x0:x1]
+    region[:] = div255(region.astype(np.int32) * (255 - alpha) + np.asarray(color, dtype=np.int32) * alpha)
+
+
+# Lay out tokens exactly like ImageFormatter._create_drawables
+def layout_tokens(tokens, styles, atlas):
+    drawables = []
+    lineno = linelength = maxlinelength = 0
+    for ttype, value in tokens:
+        while ttype not in styles:
+            ttype = ttype.parent
+        style = styles[ttype]
+        for line in value.expandtabs(TAB_SIZE).splitlines(True):
+            text = line.rstrip("\n")
+            if text:
+                drawables.append((linelength, lineno, text, style))
+                linelength += atlas.text_width(text)
+                maxlinelength = max(maxlinelength, linelength)
+            if line.endswith("\n"):
+                linelength = 0
+                lineno += 1
+    return drawables, maxlinelength, lineno
+
+
+# Where every token and line number of a code image is drawn, by line. Glyphs can reach past their
+# line's band, so each line also keeps the rows its masks cover, and reach is how many lines away
+# from its own band any line draws.
+class CodeLayout:
+    def __init__(self, tokens, font_size, style):
+        self.atlas = atlas = get_atlas(font_size)
+        drawables, maxlinelength, maxlineno = layout_tokens(tokens, get_token_styles(style), atlas)
+        self.line_height = atlas.fonth + LINE_PAD
+        self.line_number_right = IMAGE_PAD + atlas.fontw * LINE_NUMBER_CHARS + LINE_NUMBER_PAD
+        self.text_x = self.line_number_right + LINE_NUMBER_PAD
+        self.width = maxlinelength + self.text_x + IMAGE_PAD
+        self.height = maxlineno * self.line_height + 2 * IMAGE_PAD
+        self.background = ImageColor.getrgb(style.background_color or "#fff")[::-1]
+
+        # Colours are BGR, the channel order of the frames
+        self.lines = [[] for _ in range(maxlineno + 1)]
+        for x, lineno, text, token_style in drawables:
+            color = ImageColor.getrgb("#" + token_style["color"] if token_style["color"] else "#000")[::-1]
+            self.lines[lineno].append((x + self.text_x, text, font_variant(token_style), color))
+        line_number_color = ImageColor.getrgb(LINE_NUMBER_FG)[::-1]
+        for lineno in range(maxlineno):
+            self.lines[lineno].append((IMAGE_PAD, str(lineno + 1).rjust(LINE_NUMBER_CHARS), None, line_number_color))
+        self.lines = [tuple(line) for line in self.lines]
+
+        self.extents = []
+        self.reach = 0
+        for lineno, line in enumerate(self.lines):
+            top = bottom = self.line_top(lineno)
+            for _, text, variant, _ in line:
+                mask_info = atlas.text_mask(variant or "NORMAL", text)
+                if mask_info is not None:
+                    mask, _, offset_y = mask_info
+                    top = min(top, self.line_top(lineno) + offset_y)
+                    bottom = max(bottom, self.line_top(lineno) + offset_y + mask.shape[0])
+            self.extents.append((top, bottom))
+            overhang = max(self.line_top(lineno) - top, bottom - self.line_top(lineno + 1), 0)
+            self.reach = max(self.reach, -(-overhang // self.line_height))
+
+    def line_top(self, lineno):
+        return lineno * self.line_height + IMAGE_PAD
+
+    # Rows a line's pixels can cover, its own band and wherever its glyphs reach
+    def line_rows(self, lineno):
+        top, bottom = self.extents[lineno]
+        return min(top, self.line_top(lineno)), max(bottom, self.line_top(lineno + 1))
+
+    # Draw rows y0 to y1 of the code image into image, which holds just those rows. Tokens are drawn
+    # before line numbers, like ImageFormatter, so overlapping glyphs blend the same way.
+    def paint(self, image, y0, y1):
+        image[:] = self.background
+        image[:, : self.line_number_right + 1] = ImageColor.getrgb(LINE_NUMBER_BG)[::-1]
+        image[:, self.line_number_right] = ImageColor.getrgb(LINE_NUMBER_FG)[::-1]
+        first = max((y0 - IMAGE_PAD) // self.line_height - self.reach, 0)
+        last = min((y1 - IMAGE_PAD) // self.line_height + self.reach, len(self.lines) - 1)
+        line_numbers = []
+        for lineno in range(first, last + 1):
+            top, bottom = self.line_rows(lineno)
+            if bottom <= y0 or top >= y1:
+                continue
+            for x, text, variant, color in self.lines[lineno]:
+                if variant is None:
+                    line_numbers.append((x, lineno, text, color))
+                    continue
+                mask_info = self.atlas.text_mask(variant, text)
+                if mask_info is not None:
+                    draw_mask(image, mask_info, x, self.line_top(lineno) - y0, color)
+        for x, lineno, text, color in line_numbers:
+            mask_info = self.atlas.text_mask("NORMAL", text)
+            if mask_info is not None:
+                draw_mask(image, mask_info, x, self.line_top(lineno) - y0, color)
+
+    def render(self):
+        image = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.paint(image, 0, self.height)
+        return image
+
+
+# Row ranges of the code image that differ between two layouts, None when everything has moved
+def changed_rows(previous, layout):
+    if (previous.width, previous.height, previous.line_height) != (layout.width, layout.height, layout.line_height):
+        return None
+    rows = []
+    for lineno, (old_line, new_line) in enumerate(zip(previous.lines, layout.lines)):
+        if old_line == new_line:
+            continue
+        old_top, old_bottom = previous.line_rows(lineno)
+        new_top, new_bottom = layout.line_rows(lineno)
+        top, bottom = max(min(old_top, new_top), 0), min(max(old_bottom, new_bottom), layout.height)
+        if rows and top <= rows[-1][1]:
+            rows[-1] = (min(rows[-1][0], top), max(rows[-1][1], bottom))
+        else:
+            rows.append((top, bottom))
+    return rows
+
+
+# Redraw only the rows of image, the code image of previous, that change with layout
+def update_code_image(image, previous, layout):
+    rows = changed_rows(previous, layout)
+    if rows is None:
+        return None
+    for y0, y1 in rows:
+        layout.paint(image[y0:y1], y0, y1)
+    return rows
+
+
+# Render highlighted code the way highlight_code + cv2.imdecode does (a BGR array), compositing glyphs
+# from the atlas instead of drawing with Pillow and round-tripping the result through PNG
+def render_code(code, language, font_size, style, tokens=None):
+    if tokens is None:
+        tokens = get_lexer(language).get_tokens(code)
+    return CodeLayout(tokens, font_size, style).render()
@@ -0,0 +1,84 @@
+import fnmatch
+import glob
+import os
+import re
+
+from utils import logger
+
+
+class IgnoreMatcher:
+    def __init__(self, patterns):
+        patterns = [pattern for pattern in patterns if pattern]
+        self.patterns = patterns
+        self.file_regex = self._compile(patterns)
+        # A directory can be pruned when every path below it would be ignored, which holds for
+        # patterns ending in "*" that already match the directory path with a trailing separator
+        self.directory_regex = self._compile([pattern for pattern in patterns if pattern.endswith("*")])
+
+    @staticmethod
+    def _compile(patterns):
+        if not patterns:
+            return re.compile(r"(?!)")
+        return re.compile("|".join(f"(?:{fnmatch.translate(os.path.normcase(pattern))})" for pattern in patterns))
+
+    def __call__(self, path):
+        return self.file_regex.match(os.path.normcase(path)) is not None
+
+    def prunes(self, directory):
+        return self.directory_regex.match(os.path.normcase(os.path.join(directory, ""))) is not None
+
+
+def scan_tree(root, ignore):
+    # Walk root once with os.scandir, yielding (directory, files) and never descending into
+    # directories the ignore matcher prunes
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        if ignore.prunes(directory):
+            continue
+        files = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file() and not ignore(entry.path):
+                            files.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.debug(f"Unable to scan {directory}: {e}")
+            continue
+        yield directory, files
+
+
+def scan_paths(key, config, ignore=None):
+    logger.info(f"Scanning {key} paths from config")
+    ignore = ignore or IgnoreMatcher(config.get("ignore"))
+    items = [os.path.join(config.get("project_dir"), os.path.expanduser(item)) for item in config.get(key)]
+
+    # Use a dict as an ordered set so overlapping watch items are only listed once
+    paths = {}
+    for item in items:
+        if item.endswith(os.sep + "**") and not glob.has_magic(item[:-2]):
+            item = item[:-2]
+        if os.path.isdir(item):
+            roots = [item]
+        elif glob.has_magic(item):
+            roots = []
+            for match in glob.glob(item, recursive=True):
+                if os.path.isdir(match):
+                    roots.append(match)
+                elif os.path.isfile(match) and not ignore(match):
+                    paths[match] = None
+        else:
+            roots = []
+            if os.path.isfile(item) and not ignore(item):
+                paths[item] = None
+        for root in roots:
+            for _, files in scan_tree(root, ignore):
+                paths.update(dict.fromkeys(files))
+
+    logger.info(f"Found {len(paths)} paths for config['{key}']")
+    return list(paths)
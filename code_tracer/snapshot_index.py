@@ -0,0 +1,179 @@
+import json
+import os
+import sqlite3
+
+from journal import get_index_filepath, list_segments
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    session TEXT NOT NULL,
+    filepath TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    size INTEGER,
+    content_hash TEXT,
+    is_delta INTEGER NOT NULL,
+    keyframe_id INTEGER,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    UNIQUE (segment, offset)
+);
+CREATE INDEX IF NOT EXISTS snapshots_session ON snapshots (session, filepath, timestamp);
+CREATE INDEX IF NOT EXISTS snapshots_filepath ON snapshots (filepath, id);
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS segments (
+    segment INTEGER PRIMARY KEY,
+    index_position INTEGER NOT NULL
+);
+"""
+
+
+def get_index_database_filepath(output_dir):
+    return os.path.join(output_dir, "index.sqlite")
+
+
+class SnapshotIndex:
+    def __init__(self, database_filepath):
+        self.connection = sqlite3.connect(database_filepath, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    # Record journal index entries of one segment; index_position is where the segment's .idx file
+    # ends after these entries, so sync can pick up from there
+    def add_entries(self, segment, entries, index_position):
+        with self.connection:
+            for entry in entries:
+                if entry["type"] == "blob":
+                    self.connection.execute(
+                        "INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?)",
+                        (entry["hash"], segment, entry["offset"], entry["length"]),
+                    )
+                    continue
+                is_delta = entry.get("base_hash") is not None
+                keyframe_id = None
+                if is_delta:
+                    row = self.connection.execute(
+                        "SELECT keyframe_id FROM snapshots WHERE filepath = ? ORDER BY id DESC LIMIT 1",
+                        (entry["filepath"],),
+                    ).fetchone()
+                    keyframe_id = row[0] if row else None
+                cursor = self.connection.execute(
+                    (
+                        "INSERT OR IGNORE INTO snapshots"
+                        " (session, filepath, timestamp, size, content_hash, is_delta, keyframe_id,"
+                        " segment, offset, length)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                    ),
+                    (
+                        entry.get("session") or "default",
+                        entry["filepath"],
+                        entry["timestamp"],
+                        entry.get("size"),
+                        entry.get("content_hash"),
+                        is_delta,
+                        keyframe_id,
+                        segment,
+                        entry["offset"],
+                        entry["length"],
+                    ),
+                )
+                if cursor.rowcount and not is_delta:
+                    self.connection.execute("UPDATE snapshots SET keyframe_id = id WHERE id = ?", (cursor.lastrowid,))
+            self.connection.execute("INSERT OR REPLACE INTO segments VALUES (?, ?)", (segment, index_position))
+
+    # Catch up with entries appended to the journal by another process or by a migration
+    def sync(self, journal_dir):
+        positions = dict(self.connection.execute("SELECT segment, index_position FROM segments"))
+        for segment in list_segments(journal_dir):
+            index_filepath = get_index_filepath(journal_dir, segment)
+            if not os.path.exists(index_filepath) or os.path.getsize(index_filepath) == positions.get(segment):
+                continue
+            entries = []
+            with open(index_filepath, "rb") as f:
+                f.seek(positions.get(segment, 0))
+                index_position = f.tell()
+                for line in f:
+                    # Stop at a line the writer has not finished yet
+                    if not line.endswith(b"\n"):
+                        break
+                    entries.append(json.loads(line))
+                    index_position += len(line)
+            self.add_entries(segment, entries, index_position)
+
+    # Snapshots of the given sessions with content, plus the earlier snapshots their deltas build on
+    def query(self, sessions):
+        placeholders = ", ".join("?" for _ in sessions)
+        rows = {
+            row[0]: row
+            for row in self.connection.execute(
+                (
+                    "SELECT id, filepath, keyframe_id, segment, offset, length FROM snapshots"
+                    f" WHERE session IN ({placeholders}) AND (size IS NULL OR size > 0)"
+                ),
+                list(sessions),
+            )
+        }
+        selected = set(rows)
+
+        # Each delta needs every snapshot of its file from its keyframe onwards
+        chains = {}
+        for snapshot_id, filepath, keyframe_id, *_ in rows.values():
+            if keyframe_id is not None and keyframe_id < snapshot_id:
+                start, end = chains.get(filepath, (keyframe_id, snapshot_id))
+                chains[filepath] = (min(start, keyframe_id), max(end, snapshot_id))
+        for filepath, (start, end) in chains.items():
+            for row in self.connection.execute(
+                (
+                    "SELECT id, filepath, keyframe_id, segment, offset, length FROM snapshots"
+                    " WHERE filepath = ? AND id >= ? AND id < ?"
+                ),
+                (filepath, start, end),
+            ):
+                rows.setdefault(row[0], row)
+
+        return [
+            {"segment": row[3], "offset": row[4], "length": row[5], "selected": snapshot_id in selected}
+            for snapshot_id, row in sorted(rows.items())
+        ]
+
+    def blob_locations(self, content_hashes):
+        locations = {}
+        content_hashes = list(content_hashes)
+        for start in range(0, len(content_hashes), 500):
+            chunk = content_hashes[start : start + 500]
+            placeholders = ", ".join("?" for _ in chunk)
+            for content_hash, segment, offset, length in self.connection.execute(
+                f"SELECT hash, segment, offset, length FROM blobs WHERE hash IN ({placeholders})", chunk
+            ):
+                locations[content_hash] = {"segment": segment, "offset": offset, "length": length}
+        return locations
+
+    def sessions(self):
+        return self.connection.execute(
+            "SELECT session, COUNT(*), COUNT(DISTINCT filepath), MIN(timestamp), MAX(timestamp), SUM(size)"
+            " FROM snapshots GROUP BY session ORDER BY MIN(timestamp)"
+        ).fetchall()
+
+    def file_counts(self, session=None):
+        query = "SELECT session, filepath, COUNT(*), MIN(timestamp), MAX(timestamp) FROM snapshots"
+        parameters = []
+        if session:
+            query += " WHERE session = ?"
+            parameters.append(session)
+        query += " GROUP BY session, filepath ORDER BY session, COUNT(*) DESC"
+        return self.connection.execute(query, parameters).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+def open_snapshot_index(output_dir):
+    os.makedirs(output_dir, exist_ok=True, mode=0o777)
+    return SnapshotIndex(get_index_database_filepath(output_dir))
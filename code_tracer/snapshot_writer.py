@@ -0,0 +1,117 @@
+import queue
+import threading
+import time
+import zlib
+
+from metrics import metrics
+from source_files import BinaryFileError, FileTooLargeError, UndecodableFileError
+from utils import logger
+
+STOP = None
+
+
+# Persist snapshots on background threads so slow reads or writes never hold up change detection.
+# Files are sharded across threads by path, which keeps each file's snapshots in order (delta chains
+# and the unchanged-content check depend on that). The queues are bounded: when the writers fall
+# behind, submit blocks the watch loop instead of buffering without limit.
+class SnapshotWriter:
+    def __init__(self, copy_file, journal=None, threads=1, queue_size=256, batch_size=32):
+        self.copy_file = copy_file
+        self.journal = journal
+        self.batch_size = batch_size
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, threads))]
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.total_size = 0
+        self.unreadable_files = []
+        self.quarantined = []
+        self.threads = [
+            threading.Thread(target=self._run, args=(files_queue,), name=f"snapshot-writer-{i}", daemon=True)
+            for i, files_queue in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def __len__(self):
+        return sum(files_queue.qsize() for files_queue in self.queues)
+
+    def submit(self, filepath, timestamp):
+        with self.lock:
+            # A file that is still waiting will be read with its latest content anyway
+            if filepath in self.queued:
+                return
+            self.queued.add(filepath)
+        files_queue = self.queues[zlib.crc32(filepath.encode("utf-8")) % len(self.queues)]
+        files_queue.put((filepath, timestamp))
+
+    def _run(self, files_queue):
+        while True:
+            batch = [files_queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not STOP:
+                try:
+                    batch.append(files_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in batch:
+                if item is STOP:
+                    continue
+                filepath, timestamp = item
+                with self.lock:
+                    self.queued.discard(filepath)
+                self._write(filepath, timestamp)
+
+            # One fsync per batch rather than per snapshot
+            if self.journal:
+                try:
+                    self.journal.sync()
+                except OSError as e:
+                    logger.error(f"Unable to sync journal: {e}")
+
+            for _ in batch:
+                files_queue.task_done()
+            if batch[-1] is STOP:
+                return
+
+    def _write(self, filepath, timestamp):
+        start = time.perf_counter()
+        try:
+            size_changed = self.copy_file(filepath, timestamp)
+            with self.lock:
+                self.total_size += size_changed
+            metrics.observe("write_latency_seconds", time.perf_counter() - start)
+            if size_changed:
+                metrics.inc("snapshots_written_total")
+                metrics.inc("snapshot_bytes_written_total", size_changed)
+        except BinaryFileError as e:
+            metrics.inc("files_quarantined_total")
+            logger.warning(f'Unable to read file {e}, no longer watching it.')
+            with self.lock:
+                self.unreadable_files.append(filepath)
+                self.quarantined.append(filepath)
+        except UndecodableFileError as e:
+            # Stays watched, the next change reads the file again
+            logger.warning(f'Skipping file {e}.')
+        except FileTooLargeError as e:
+            # Oversized files stay watched (they may shrink again) but are only reported once
+            with self.lock:
+                if filepath in self.unreadable_files:
+                    return
+                self.unreadable_files.append(filepath)
+            logger.warning(f'Skipping file {e}.')
+        except Exception as e:
+            metrics.inc("write_errors_total")
+            logger.error(f'Unable to save file {filepath}: {e}')
+
+    # Files found to be binary since the last call
+    def take_quarantined(self):
+        with self.lock:
+            quarantined, self.quarantined = self.quarantined, []
+        return quarantined
+
+    # Write everything still queued, then stop the writer threads
+    def close(self):
+        for files_queue in self.queues:
+            files_queue.put(STOP)
+        for thread in self.threads:
+            thread.join()
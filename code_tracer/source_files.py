@@ -0,0 +1,69 @@
+import codecs
+import mmap
+import os
+
+# Bytes looked at to decide whether a file is binary
+SNIFF_BYTES = 8192
+
+
+class UnreadableFileError(Exception):
+    def __init__(self, filepath, reason):
+        super().__init__(f"{filepath}: {reason}")
+        self.filepath = filepath
+
+
+class BinaryFileError(UnreadableFileError):
+    def __init__(self, filepath):
+        super().__init__(filepath, "not a UTF-8 text file")
+
+
+# The file did not look binary but is not valid UTF-8 as a whole, e.g. a character was cut off by a
+# write still in progress. Unlike a binary file it is read again on its next change.
+class UndecodableFileError(UnreadableFileError):
+    def __init__(self, filepath):
+        super().__init__(filepath, "not valid UTF-8, it may still be being written")
+
+
+class FileTooLargeError(UnreadableFileError):
+    def __init__(self, filepath, size, max_size):
+        super().__init__(filepath, f"{size} bytes is over the {max_size} byte snapshot limit")
+        self.size = size
+
+
+def looks_binary(head):
+    if b"\0" in head:
+        return True
+    try:
+        # final=False so a character cut off at the end of head is not an error
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def decode_text(filepath, data):
+    try:
+        content = str(data, "utf-8")
+    except UnicodeDecodeError:
+        raise UndecodableFileError(filepath) from None
+    # Match the newline translation of files opened in text mode
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+    return content
+
+
+# Read a watched file as text. Binary files are detected from their first bytes before the rest is
+# read, files over max_size are not read at all and files of mmap_threshold bytes or more are decoded
+# straight from a memory map instead of being copied into a buffer first.
+def read_source_file(filepath, max_size=0, mmap_threshold=0):
+    size = os.path.getsize(filepath)
+    if max_size and size > max_size:
+        raise FileTooLargeError(filepath, size, max_size)
+    with open(filepath, "rb") as f:
+        head = f.read(SNIFF_BYTES)
+        if looks_binary(head):
+            raise BinaryFileError(filepath)
+        if not mmap_threshold or size < mmap_threshold or len(head) < SNIFF_BYTES:
+            return decode_text(filepath, head + f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return decode_text(filepath, data)
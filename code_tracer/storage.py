@@ -0,0 +1,197 @@
+import difflib
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+from constants import TIME_FORMAT
+from journal import Journal, get_journal_dir, iter_records, read_records
+from snapshot_index import open_snapshot_index
+from utils import logger
+
+TIMESTAMP_LENGTH = len(time.strftime(TIME_FORMAT, time.gmtime(0)))
+
+
+def open_journal(output_dir, config):
+    journal_dir = get_journal_dir(output_dir)
+    index = None
+    if config.get("snapshot_index"):
+        index = open_snapshot_index(output_dir)
+        index.sync(journal_dir)
+    return Journal(
+        journal_dir,
+        compression=config.get("journal_compression"),
+        segment_size=config.get("journal_segment_size"),
+        index=index,
+    )
+
+
+def hash_content(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_blob_filepath(output_dir, content_hash):
+    return os.path.join(output_dir, "blobs", content_hash[:2], content_hash)
+
+
+# Store content once under its hash, returning the number of bytes written (0 if it already existed)
+def write_blob(output_dir, content, content_hash=None):
+    content_hash = content_hash or hash_content(content)
+    blob_filepath = get_blob_filepath(output_dir, content_hash)
+    if os.path.exists(blob_filepath):
+        return 0
+    os.makedirs(os.path.dirname(blob_filepath), exist_ok=True, mode=0o777)
+    data = content.encode("utf-8")
+    temp_filepath = f"{blob_filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_filepath, "wb") as f:
+        f.write(data)
+    os.replace(temp_filepath, blob_filepath)
+    return len(data)
+
+
+def read_blob(output_dir, content_hash):
+    with open(get_blob_filepath(output_dir, content_hash), "r", encoding="utf-8", newline="") as f:
+        return f.read()
+
+
+# Describe new_content as the line ranges of old_content it replaces: [[start, end, new_lines], ...]
+def create_delta(old_content, new_content):
+    old_lines = old_content.splitlines(keepends=True)
+    new_lines = new_content.splitlines(keepends=True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    return [[i1, i2, new_lines[j1:j2]] for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+
+def apply_delta(old_lines, delta):
+    new_lines = []
+    position = 0
+    for start, end, lines in delta:
+        new_lines.extend(old_lines[position:start])
+        new_lines.extend(lines)
+        position = end
+    new_lines.extend(old_lines[position:])
+    return new_lines
+
+
+# Fill in "content" for snapshot records that reference a blob or a delta, in a single pass.
+# Records must be in chronological order so each delta finds the previous snapshot of its file.
+def resolve_contents(change_files, output_dir, blobs=None):
+    blobs = {} if blobs is None else blobs
+    previous = {}
+    for change_file in change_files:
+        content_hash = change_file.get("content_hash")
+        lines = None
+        if "delta" in change_file:
+            base_hash, base_content, base_lines = previous.get(change_file["filepath"], (None, None, None))
+            if base_hash != change_file.get("base_hash"):
+                logger.warning(f"Missing base snapshot for delta of {change_file['filepath']}, skipping.")
+                change_file["content"] = ""
+                continue
+            if base_lines is None:
+                base_lines = base_content.splitlines(keepends=True)
+            lines = apply_delta(base_lines, change_file.pop("delta"))
+            change_file["content"] = "".join(lines)
+        elif "content" not in change_file and content_hash:
+            if content_hash not in blobs:
+                blobs[content_hash] = read_blob(output_dir, content_hash)
+            change_file["content"] = blobs[content_hash]
+        previous[change_file["filepath"]] = (content_hash, change_file["content"], lines)
+    return change_files
+
+
+def load_legacy_change_files(output_dir):
+    change_filenames = sorted(glob.glob(os.path.join(output_dir, "changes", "*")))
+    change_files = []
+    for change_filename in change_filenames:
+        with open(change_filename, "r") as f:
+            change_file = json.load(f)
+        change_file.setdefault("timestamp", os.path.basename(change_filename)[:TIMESTAMP_LENGTH])
+        change_files.append(change_file)
+    return change_files
+
+
+# Snapshot count, first and last timestamp by session and file of the per-file layout, which the snapshot
+# index does not cover until the snapshots are migrated into the journal
+def legacy_file_counts(output_dir):
+    counts = {}
+    for change_file in load_legacy_change_files(output_dir):
+        timestamp = change_file["timestamp"]
+        key = (change_file.get("session") or "default", change_file["filepath"])
+        count, first, last = counts.get(key, (0, timestamp, timestamp))
+        counts[key] = (count + 1, min(first, timestamp), max(last, timestamp))
+    return counts
+
+
+# Load snapshots from the journal, using the snapshot index to read only the given sessions
+def load_journal_change_files(output_dir, sessions):
+    journal_dir = get_journal_dir(output_dir)
+    index = open_snapshot_index(output_dir)
+    try:
+        index.sync(journal_dir)
+        locations = index.query(sessions)
+        change_files = read_records(journal_dir, locations)
+        content_hashes = {
+            change_file["content_hash"]
+            for change_file in change_files
+            if "delta" not in change_file and "content" not in change_file and change_file.get("content_hash")
+        }
+        blob_locations = list(index.blob_locations(content_hashes).values())
+    finally:
+        index.close()
+    blobs = {blob["hash"]: blob["content"] for blob in read_records(journal_dir, blob_locations)}
+    change_files = resolve_contents(change_files, output_dir, blobs)
+    # Drop the earlier snapshots that were only read to rebuild deltas
+    return [change_file for change_file, location in zip(change_files, locations) if location["selected"]]
+
+
+# Load every snapshot from the per-file layout and the journal, in chronological order. When sessions
+# are given, journal snapshots outside them are not read at all.
+def load_change_files(output_dir, sessions=None):
+    change_files = load_legacy_change_files(output_dir)
+    if change_files:
+        logger.info(f"Loaded {len(change_files)} change files, run migrate_changes to pack them into the journal.")
+
+    journal_dir = get_journal_dir(output_dir)
+    if os.path.isdir(journal_dir) and sessions:
+        change_files.extend(load_journal_change_files(output_dir, sessions))
+        blobs = {}
+    else:
+        blobs = {}
+        if os.path.isdir(journal_dir):
+            for record in iter_records(journal_dir):
+                if record.get("type") == "blob":
+                    blobs[record["hash"]] = record["content"]
+                else:
+                    change_files.append(record)
+
+    change_files.sort(key=lambda change_file: change_file["timestamp"])
+    return resolve_contents(change_files, output_dir, blobs)
+
+
+# Move the per-file change layout (and its blob files) into the journal
+def migrate_change_files(output_dir, config):
+    change_files = load_legacy_change_files(output_dir)
+    if not change_files:
+        logger.info("No change files to migrate.")
+        return 0
+
+    journal = open_journal(output_dir, config)
+    try:
+        for change_file in change_files:
+            content_hash = change_file.get("content_hash")
+            if "content" not in change_file and "delta" not in change_file and content_hash:
+                journal.write_blob(content_hash, read_blob(output_dir, content_hash))
+            journal.append(change_file)
+    finally:
+        journal.close()
+
+    # Keep the old layout next to the journal until the user removes it
+    for directory in ("changes", "blobs"):
+        directory = os.path.join(output_dir, directory)
+        if os.path.isdir(directory):
+            os.rename(directory, f"{directory}.migrated")
+            logger.info(f"Moved {directory} to {directory}.migrated, it can be deleted.")
+    logger.info(f"Migrated {len(change_files)} change files into {get_journal_dir(output_dir)}.")
+    return len(change_files)
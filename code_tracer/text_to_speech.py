@@ -1,17 +1,158 @@
-from google.cloud import texttospeech
+import hashlib
+import json
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from utils import load_environment
 
+# Google accepts at most 5000 bytes of input per request
+MAX_CHUNK_BYTES = 4500
+AUDIO_ENCODING = "MP3"
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+# Speech from Google Cloud Text-to-Speech. The client is built once and shared by the synthesis threads.
+class GoogleBackend:
+    def __init__(self, language_code, voice_gender):
+        load_environment()
+        from google.cloud import texttospeech
+
+        self.texttospeech = texttospeech
+        self.client = texttospeech.TextToSpeechClient()
+        self.voice = texttospeech.VoiceSelectionParams(
+            language_code=language_code, ssml_gender=texttospeech.SsmlVoiceGender[voice_gender]
+        )
+        self.audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding[AUDIO_ENCODING])
+
+    def synthesize(self, text):
+        synthesis_input = self.texttospeech.SynthesisInput(text=text)
+        response = self.client.synthesize_speech(
+            input=synthesis_input, voice=self.voice, audio_config=self.audio_config
+        )
+        return response.audio_content
+
+
+# Returns a recorded MP3 for every chunk, to run without network access or credentials in tests and CI
+class FixtureBackend:
+    def __init__(self, filepath):
+        with open(os.path.expanduser(filepath), "rb") as f:
+            self.audio_content = f.read()
+
+    def synthesize(self, text):
+        return self.audio_content
+
+
+def get_speech_backend(config):
+    backend = config.get("tts_backend")
+    if backend == "google":
+        return GoogleBackend(config.get("tts_language_code"), config.get("tts_voice_gender"))
+    if backend == "fixture":
+        return FixtureBackend(config.get("tts_fixture_filepath"))
+    raise ValueError(f"Unknown text to speech backend: {backend}")
+
+
+# Split text into chunks of whole sentences that each fit in one request. A sentence that is too long on
+# its own is split between words.
+def split_text(text, max_bytes=MAX_CHUNK_BYTES):
+    chunks = []
+    chunk = ""
+    for sentence in SENTENCE_END.split(text.strip()):
+        for part in split_sentence(sentence, max_bytes):
+            candidate = f"{chunk} {part}" if chunk else part
+            if len(candidate.encode("utf-8")) <= max_bytes:
+                chunk = candidate
+            else:
+                chunks.append(chunk)
+                chunk = part
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def split_sentence(sentence, max_bytes):
+    if len(sentence.encode("utf-8")) <= max_bytes:
+        return [sentence]
+    parts = []
+    part = ""
+    for word in sentence.split():
+        while len(word.encode("utf-8")) > max_bytes:
+            if part:
+                parts.append(part)
+                part = ""
+            head = word.encode("utf-8")[:max_bytes].decode("utf-8", errors="ignore")
+            parts.append(head)
+            word = word[len(head) :]
+        candidate = f"{part} {word}" if part else word
+        if len(candidate.encode("utf-8")) <= max_bytes:
+            part = candidate
+        else:
+            parts.append(part)
+            part = word
+    if part:
+        parts.append(part)
+    return parts
+
+
+# Where speech comes from, so that fixture audio is never used for Google or for another fixture
+def get_speech_source(config):
+    backend = config.get("tts_backend")
+    if backend == "fixture":
+        return [backend, os.path.abspath(os.path.expanduser(config.get("tts_fixture_filepath")))]
+    return [backend]
+
+
+def get_speech_cache_filepath(text, config):
+    voice = [config.get("tts_language_code"), config.get("tts_voice_gender"), AUDIO_ENCODING]
+    key = json.dumps([get_speech_source(config), text, *voice])
+    cache_dir = os.path.join(os.path.expanduser(config.get("output_dir")), "tts_cache")
+    return os.path.join(cache_dir, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.mp3")
+
+
+def read_cached_speech(text, config):
+    if not config.get("tts_cache"):
+        return None
+    cache_filepath = get_speech_cache_filepath(text, config)
+    if not os.path.exists(cache_filepath):
+        return None
+    with open(cache_filepath, "rb") as f:
+        return f.read()
+
+
+def synthesize_chunk(backend, text, config):
+    audio_content = backend.synthesize(text)
+    if config.get("tts_cache"):
+        cache_filepath = get_speech_cache_filepath(text, config)
+        os.makedirs(os.path.dirname(cache_filepath), exist_ok=True, mode=0o777)
+        temp_filepath = f"{cache_filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_filepath, "wb") as out:
+            out.write(audio_content)
+        os.replace(temp_filepath, cache_filepath)
+    return audio_content
+
+
+# Synthesize the text a chunk at a time, reusing chunks that the same backend synthesized with the same
+# voice before, and join the chunks. MP3 streams of the same voice and encoding can be concatenated as
+# they are.
 def text_to_speech(text, config, logger):
     logger.info("Converting text to speech...")
-    client = texttospeech.TextToSpeechClient()
-    synthesis_input = texttospeech.SynthesisInput(text=text)
-    voice = texttospeech.VoiceSelectionParams(language_code="en-US", ssml_gender=texttospeech.SsmlVoiceGender.NEUTRAL)
-    audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
-    response = client.synthesize_speech(input=synthesis_input, voice=voice, audio_config=audio_config)
+    chunks = split_text(text) or [text]
+    audio = [read_cached_speech(chunk, config) for chunk in chunks]
+    missing = [index for index, audio_content in enumerate(audio) if audio_content is None]
+    logger.info(f"Synthesizing {len(missing)} of {len(chunks)} speech chunks, the rest are cached")
+    if missing:
+        backend = get_speech_backend(config)
+        with ThreadPoolExecutor(max_workers=min(config.get("tts_workers"), len(missing))) as executor:
+            synthesized = executor.map(lambda index: synthesize_chunk(backend, chunks[index], config), missing)
+            for index, audio_content in zip(missing, synthesized):
+                audio[index] = audio_content
+
     output_location = config.get("video_output_dir")
     output_file = os.path.join(output_location, 'audio.mp3')
     with open(output_file, "wb") as out:
-        out.write(response.audio_content)
+        for audio_content in audio:
+            out.write(audio_content)
         logger.info(f'Audio content written to file: {output_file}')
-    return output_file
\ No newline at end of file
+    return output_file
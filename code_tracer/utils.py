@@ -1,5 +1,7 @@
-import logging
+import functools
 import json
+import logging
+
 from constants import DEFAULTS
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -11,18 +13,24 @@ class Config:
     def __init__(self, filepath) -> None:
         self.filepath = filepath
         self.load(self.filepath)
-        self._add_defaults()
         self.local_config = {}
 
+    # The file is only rewritten when defaults were added or the session lists changed
     def _add_defaults(self):
+        changed = False
         for key, value in DEFAULTS.items():
             if key not in self.config:
                 logger.info(f"Key {key} not found in config, using default value {value}")
                 self.config[key] = value
-        self.config["render_sessions"] = list(set(self.config["render_sessions"]))
-        self.config["all_sessions"] = list(set(self.config["all_sessions"]))
-        self.config["render_sessions"].sort()
-        self.write(self.filepath)
+                changed = True
+        render_sessions = sorted(set(self.config["render_sessions"]))
+        all_sessions = list(dict.fromkeys(self.config["all_sessions"]))
+        if render_sessions != self.config["render_sessions"] or all_sessions != self.config["all_sessions"]:
+            self.config["render_sessions"] = render_sessions
+            self.config["all_sessions"] = all_sessions
+            changed = True
+        if changed:
+            self.write(self.filepath)
         self.config["session_folder"] = "_".join(self.config["render_sessions"])
 
     def load(self, filepath):
@@ -63,3 +71,11 @@ class Config:
 
     def check_errors(self):
         pass
+
+
+# Load variables from a .env file the first time a service client needs them
+@functools.lru_cache(maxsize=None)
+def load_environment():
+    from dotenv import load_dotenv
+
+    load_dotenv()
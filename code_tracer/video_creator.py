@@ -1,35 +1,47 @@
-import cv2
-import glob
-import json
+import collections
+import concurrent.futures
+import contextlib
+import fractions
 import math
 import multiprocessing
-import numpy as np
 import os
-from tqdm import tqdm
 
+import cv2
+import numpy as np
+from PIL import ImageColor
+from pygments import format as format_tokens
 from pygments import highlight
-from pygments.lexers import get_lexer_by_name
 from pygments.formatters import ImageFormatter
+from pygments.lexers import get_lexer_by_name
 from pygments.styles import get_style_by_name
-from moviepy.editor import ImageSequenceClip, AudioFileClip
-from PIL import ImageColor
-
-from utils import Config, logger
+from tqdm import tqdm
 
-from get_manuscript import create_payload, get_manuscript
+from encoder import FrameEncoder, PermitPool, imap_window, mux_audio
+from frame_cache import FrameCache
+from frame_ring import FrameRing, shared_memory_fits, write_frame
+from get_manuscript import create_payload, get_manuscript, reduce_payload
+from gif_writer import GifWriter, OrderedGifWriter
+from layout import fit_font_size, measure_text
+from lexing import token_cache
+from renderer import CodeLayout, render_code, update_code_image
+from storage import hash_content, load_change_files
 from text_to_speech import text_to_speech
+from utils import Config, logger
 
-
-STYLE = get_style_by_name('bw')
+STYLE_NAME = 'bw'
+STYLE = get_style_by_name(STYLE_NAME)
 BACKROUND_COLOR = ImageColor.getrgb(STYLE.background_color)
 HEADER_FONT = cv2.FONT_HERSHEY_SIMPLEX
 HEADER_FONT_SCALE = 0.8
 HEADER_FONT_THICKNESS = 2
+# Frames kept per process to render the next snapshot of the same file from
+MAX_PREVIOUS_FRAMES = 4
 
+# Last frame rendered for each file, resolution and font size, with its code image and layout
+previous_frames = collections.OrderedDict()
 
-def highlight_code(code, language, font_size=24):
-    lexer = get_lexer_by_name(language)
-    lexer.stripnl = False
+
+def highlight_code(code, language, font_size=24, tokens=None):
     formatter = ImageFormatter(
         font_size=font_size,
         style=STYLE,
@@ -38,9 +50,22 @@ def highlight_code(code, language, font_size=24):
         line_number_bg="#000000",
         line_number_fg='#ffffff',
     )
+    if tokens is not None:
+        return format_tokens(tokens, formatter)
+    lexer = get_lexer_by_name(language)
+    lexer.stripnl = False
     return highlight(code, lexer, formatter)
 
 
+# Highlighted code as a BGR image. The atlas renderer draws the same pixels as the Pygments
+# ImageFormatter without the PIL drawing and PNG round trip.
+def render_code_image(code, language, font_size, renderer="pygments", tokens=None):
+    if renderer == "atlas":
+        return render_code(code, language, font_size, STYLE, tokens=tokens)
+    code_image = np.frombuffer(highlight_code(code, language, font_size=font_size, tokens=tokens), dtype=np.uint8)
+    return cv2.imdecode(code_image, cv2.IMREAD_UNCHANGED)
+
+
 def group_by_file(changes_files, flatten=False):
     grouped_changes = {}
     for change_file in changes_files:
@@ -55,8 +80,12 @@ def group_by_file(changes_files, flatten=False):
     return grouped_changes
 
 
+def get_header_text(change_file):
+    return f"{change_file['github_username']}::{change_file['project_name']}::{change_file['filepath']}"
+
+
 def add_header(change_file, canvas=None):
-    text = f"{change_file['github_username']}::{change_file['project_name']}::{change_file['filepath']}"
+    text = get_header_text(change_file)
     header_size, _ = cv2.getTextSize(text, HEADER_FONT, HEADER_FONT_SCALE, HEADER_FONT_THICKNESS)
     if canvas is not None:
         cv2.putText(canvas, text, (0, header_size[1]), HEADER_FONT, HEADER_FONT_SCALE, (0, 0, 0), HEADER_FONT_THICKNESS)
@@ -67,6 +96,26 @@ def add_filler_lines(change_file):
     return change_file["content"] + ("\n" * (change_file["max_lines"] - change_file["total_lines"]))
 
 
+# Tokens of the code rendered for a change file, lexed once per run for every resolution
+def get_code_tokens(change_file, code):
+    return token_cache.get_tokens(change_file["filepath"], change_file["language"], code)
+
+
+# Lex every snapshot before the render pools start, so the worker processes inherit the tokens. Going
+# through each file's snapshots in order lets every snapshot be lexed from where it differs from the
+# previous one.
+def tokenize_change_files(change_files):
+    logger.info("Lexing change files...")
+    for file_change_files in group_by_file(change_files).values():
+        for change_file in file_change_files:
+            get_code_tokens(change_file, add_filler_lines(change_file))
+    if token_cache.total_chars:
+        logger.info(
+            f"Lexed {token_cache.misses} snapshots, re-lexing"
+            f" {token_cache.lexed_chars / token_cache.total_chars:.1%} of their text."
+        )
+
+
 def create_canvas(dimensions):
     canvas_r = np.full((dimensions[1], dimensions[0]), dtype=np.uint8, fill_value=BACKROUND_COLOR[0])
     canvas_g = np.full((dimensions[1], dimensions[0]), dtype=np.uint8, fill_value=BACKROUND_COLOR[1])
@@ -75,17 +124,20 @@ def create_canvas(dimensions):
     return canvas
 
 
-def create_image(change_file, dimensions, final_font_size):
+def create_image(change_file, dimensions, final_font_size, renderer="pygments", code_image=None):
     canvas = create_canvas(dimensions)
     header_size = add_header(change_file, canvas=canvas)
     extended_content = add_filler_lines(change_file)
     max_code_height = dimensions[1] - header_size[1]
 
-    code_image = np.frombuffer(
-        highlight_code(extended_content, change_file["language"], font_size=final_font_size),
-        dtype=np.uint8,
-    )
-    code_image = cv2.imdecode(code_image, cv2.IMREAD_UNCHANGED)
+    if code_image is None:
+        code_image = render_code_image(
+            extended_content,
+            change_file["language"],
+            final_font_size,
+            renderer,
+            get_code_tokens(change_file, extended_content),
+        )
 
     code_image_slice = code_image
     code_image_width = code_image.shape[1]
@@ -118,48 +170,251 @@ def create_image(change_file, dimensions, final_font_size):
     return canvas
 
 
-def create_gif(config, gif_clip, change_files, gif_output_dir):
+# Copy rows y0 to y1 of the code image into the columns create_image laid it out in. Columns that
+# create_image could not fit on the canvas are left out here too.
+def paste_code_rows(canvas, code_image, header_height, y0, y1):
+    max_code_height = canvas.shape[0] - header_height
+    code_image_width = code_image.shape[1]
+    slice_width = min(code_image_width, canvas.shape[1])
+    for i in range(y0 // max_code_height, (y1 - 1) // max_code_height + 1):
+        x = i * code_image_width
+        if x + slice_width > canvas.shape[1]:
+            continue
+        top, bottom = max(y0, i * max_code_height), min(y1, (i + 1) * max_code_height)
+        canvas[
+            header_height + top - i * max_code_height : header_height + bottom - i * max_code_height,
+            x : x + slice_width,
+        ] = code_image[top:bottom, :slice_width]
+
+
+# Render a frame from the last frame of the same file this process rendered, redrawing only the
+# lines that changed and copying the rest. Falls back to a full render when the code image changes
+# size or there is no earlier frame.
+def create_image_incremental(change_file, dimensions, final_font_size):
+    extended_content = add_filler_lines(change_file)
+    layout = CodeLayout(get_code_tokens(change_file, extended_content), final_font_size, STYLE)
+    key = (change_file["filepath"], tuple(dimensions), final_font_size)
+    previous = previous_frames.pop(key, None)
+    rows = None
+    if previous is not None:
+        previous_layout, code_image, previous_canvas = previous
+        rows = update_code_image(code_image, previous_layout, layout)
+    if rows is None:
+        code_image = layout.render()
+        canvas = create_image(change_file, dimensions, final_font_size, "atlas", code_image=code_image)
+    else:
+        canvas = previous_canvas.copy()
+        header_height = add_header(change_file)[1]
+        for y0, y1 in rows:
+            paste_code_rows(canvas, code_image, header_height, y0, y1)
+
+    previous_frames[key] = (layout, code_image, canvas)
+    while len(previous_frames) > MAX_PREVIOUS_FRAMES:
+        previous_frames.popitem(last=False)
+    return canvas
+
+
+def render_frame(change_file, dimensions, final_font_size, renderer="pygments", incremental=False):
+    if incremental and renderer == "atlas":
+        return create_image_incremental(change_file, dimensions, final_font_size)
+    return create_image(change_file, dimensions, final_font_size, renderer)
+
+
+# Return the frame for a change file and whether it came from the frame cache
+def get_frame(change_file, dimensions, final_font_size, frame_cache=None, renderer="pygments", incremental=False):
+    if frame_cache is None:
+        return render_frame(change_file, dimensions, final_font_size, renderer, incremental), False
+    key = FrameCache.get_key(
+        change_file.get("content_hash") or hash_content(change_file["content"]),
+        change_file["language"],
+        final_font_size,
+        dimensions,
+        STYLE_NAME,
+        get_header_text(change_file),
+        change_file["max_lines"],
+        renderer,
+    )
+    img = frame_cache.get(key)
+    if img is not None:
+        return img, True
+    img = render_frame(change_file, dimensions, final_font_size, renderer, incremental)
+    frame_cache.put(key, img)
+    return img, False
+
+
+# Render a run of snapshots of one file in order, so each frame can be drawn from the one before it.
+# group is the slot group held by the task, which only matters with a frame ring.
+def get_frames(frame_args, group=None):
+    return [get_frame(*args) for args in frame_args]
+
+
+# Like get_frames, but the frames are written to the ring's group of chunk_size slots the task holds,
+# and only the slot of each frame and whether it came from the frame cache are sent back
+def render_frames_to_ring(frame_args, ring_name, frame_size, chunk_size, group):
     frames = []
-    logger.info(f"Processing gif for {gif_clip['name']}")
-    gif_frames = int(config.get("gif_length", 5) / len(gif_clip["files"]) * config.get("gif_fps")) or 1
-    for change_file in change_files:
-        img = create_image(change_file, gif_clip["dimensions"], change_file["font_size"][f"{gif_clip['name']}_gif"])
-        frames.extend([img] * gif_frames)
-    if frames:
-        clip = ImageSequenceClip(frames, fps=config.get("gif_fps"))
-        output_filename = f"{config.get('name')}_{gif_clip['name']}_{change_files[0]['filepath']}.gif"
-        output_filepath = os.path.join(gif_output_dir, output_filename)
-        clip.write_gif(output_filepath, fps=config.get("gif_fps"))
+    for slot, args in enumerate(frame_args, group * chunk_size):
+        img, hit = get_frame(*args)
+        write_frame(ring_name, frame_size, slot, img)
+        frames.append((slot, hit))
+    return frames
+
+
+# Split frame arguments into runs of at most chunk_size consecutive frames of the same file
+def chunk_frames(frame_args, chunk_size):
+    chunks = []
+    for args in frame_args:
+        if chunks and len(chunks[-1]) < chunk_size and chunks[-1][-1][0]["filepath"] == args[0]["filepath"]:
+            chunks[-1].append(args)
+        else:
+            chunks.append([args])
+    return chunks
 
 
-def create_gifs(config, change_files):
-    gif_output_dir = os.path.expanduser(os.path.join(config.get("output_dir"), "gifs", config.get("session_folder")))
+def get_gif_output_dir(config):
+    return os.path.expanduser(os.path.join(config.get("output_dir"), "gifs", config.get("session_folder")))
 
-    os.makedirs(gif_output_dir, exist_ok=True)
 
-    gif_change_files = group_by_file(change_files)
-    gif_clips = [
-        {"name": resolution["name"], "dimensions": resolution["dimensions"], "files": gif_change_files}
+def get_gif_clips(config, change_files):
+    file_count = len(group_by_file(change_files))
+    return [
+        {"name": resolution["name"], "dimensions": resolution["dimensions"], "file_count": file_count}
         for resolution in config.get("gif_resolutions")
     ]
 
-    processes = []
-    logger.info("Creating gifs...")
-    for gif_clip in gif_clips:
-        logger.info(f"Processing {gif_clip['name']}")
-        for gif_change_file_group in gif_clip["files"].values():
-            p = multiprocessing.Process(
-                target=create_gif,
-                args=(config, gif_clip, gif_change_file_group, gif_output_dir),
-            )
-            processes.append(p)
-            p.start()
 
-    for p in processes:
-        p.join()
+def get_gif_filepath(config, gif_clip, filepath, gif_output_dir):
+    return os.path.join(gif_output_dir, f"{config.get('name')}_{gif_clip['name']}_{filepath}.gif")
+
+
+# How long each snapshot is shown in a gif, in milliseconds
+def get_gif_frame_duration(config, gif_clip):
+    gif_frames = int(config.get("gif_length", 5) / gif_clip["file_count"] * config.get("gif_fps")) or 1
+    return gif_frames * 1000 / config.get("gif_fps")
 
 
-def create_video(config, change_files):
+# Gifs at the dimensions of a video resolution, of files whose font size is the same in the gif and the
+# video, are made of the video's frames as they are encoded. Returns the video resolution's name and a
+# writer for each such gif, by gif resolution name and file.
+def get_video_gifs(config, change_files):
+    video_names = {
+        tuple(resolution["dimensions"]): resolution["name"] for resolution in config.get("video_resolutions")
+    }
+    gif_output_dir = get_gif_output_dir(config)
+    video_gifs = {}
+    for gif_clip in get_gif_clips(config, change_files):
+        video_name = video_names.get(tuple(gif_clip["dimensions"]))
+        if video_name is None:
+            continue
+        for filepath, file_change_files in group_by_file(change_files).items():
+            font_size = file_change_files[0]["font_size"]
+            if font_size[f"{gif_clip['name']}_gif"] == font_size[f"{video_name}_video"]:
+                writer = OrderedGifWriter(
+                    get_gif_filepath(config, gif_clip, filepath, gif_output_dir),
+                    get_gif_frame_duration(config, gif_clip),
+                )
+                video_gifs[(gif_clip["name"], filepath)] = (video_name, writer)
+    return video_gifs
+
+
+# Render the gif of one file at one resolution, returns the frame cache hits and misses
+def create_gif(config, gif_clip, change_files, gif_output_dir, frame_cache=None):
+    hits = 0
+    logger.info(f"Processing gif for {gif_clip['name']}")
+    duration = get_gif_frame_duration(config, gif_clip)
+    writer = GifWriter(get_gif_filepath(config, gif_clip, change_files[0]["filepath"], gif_output_dir))
+    for change_file in change_files:
+        img, hit = get_frame(
+            change_file,
+            gif_clip["dimensions"],
+            change_file["font_size"][f"{gif_clip['name']}_gif"],
+            frame_cache,
+            config.get("renderer"),
+            config.get("incremental_render"),
+        )
+        hits += hit
+        writer.add(img, duration)
+    writer.close()
+    return hits, len(change_files) - hits
+
+
+def create_gifs(config, change_files, pool, frame_cache=None, video_gifs=None):
+    video_gifs = video_gifs or {}
+    gif_output_dir = get_gif_output_dir(config)
+
+    os.makedirs(gif_output_dir, exist_ok=True)
+
+    # One gif per file and resolution, rendered on the video's pool, except the gifs the video's frames
+    # were collected for. Those are written while the pool renders the rest.
+    gif_args = [
+        (config, gif_clip, gif_change_file_group, gif_output_dir, frame_cache)
+        for gif_clip in get_gif_clips(config, change_files)
+        for filepath, gif_change_file_group in group_by_file(change_files).items()
+        if (gif_clip["name"], filepath) not in video_gifs
+    ]
+    logger.info(f"Creating {len(gif_args)} gifs, and {len(video_gifs)} from the video's frames...")
+    results = pool.starmap_async(create_gif, gif_args)
+    for _, writer in video_gifs.values():
+        writer.close()
+    for hits, misses in results.get():
+        if frame_cache:
+            frame_cache.hits += hits
+            frame_cache.misses += misses
+
+
+# The manuscript and its audio, from a payload that has already been reduced
+def create_narration(payload, config):
+    manuscript = get_manuscript(payload, config, logger, reduce=False)
+    return text_to_speech(manuscript, config, logger)
+
+
+# Render frames in the pool and encode them in order into one video file. Runs in a thread per file
+# being encoded, returns the video's duration and the frame cache hits and misses. frame_gifs has the
+# (writer, index) of the gifs each frame is also added to. slot_groups is shared by the files encoded
+# at the same time, and each of their tasks in flight holds one of its groups. With a ring the frames
+# come back through the task's group of chunk_size slots, which no other task writes to until this
+# encoder has moved on to its next chunk.
+def encode_video(
+    pool,
+    video_filepath,
+    dimensions,
+    fps,
+    frame_args,
+    repeat,
+    chunk_size,
+    window,
+    slot_groups,
+    progress,
+    ring=None,
+    frame_gifs=None,
+):
+    hits = misses = 0
+    frame_index = 0
+    shape = (dimensions[1], dimensions[0], 3)
+    chunks = chunk_frames(frame_args, chunk_size)
+    with FrameEncoder(video_filepath, dimensions, fps) as encoder:
+        if ring:
+            # Slot numbers instead of frames, each frame is read from the ring as it is encoded
+            tasks = [(chunk, ring.name, ring.frame_size, chunk_size) for chunk in chunks]
+            frame_results = imap_window(pool, render_frames_to_ring, tasks, window, slot_groups)
+        else:
+            frame_results = imap_window(pool, get_frames, [(chunk,) for chunk in chunks], window, slot_groups)
+        for frames in frame_results:
+            for frame, hit in frames:
+                hits += hit
+                misses += not hit
+                image = ring.frame(frame, shape) if ring else frame
+                encoder.write(image, repeat=repeat)
+                if frame_gifs and frame_gifs[frame_index]:
+                    # A ring slot is written again by a later task
+                    image = image.copy() if ring else image
+                    for writer, index in frame_gifs[frame_index]:
+                        writer.add_at(index, image)
+                frame_index += 1
+            progress.update(len(frames))
+    return encoder.duration, hits, misses
+
+
+def create_video(config, change_files, pool, frame_cache=None, video_gifs=None):
     video_frames = int(config.get("video_length", 300) / len(change_files) * config.get("video_fps")) or 1
     video_output_dir = os.path.expanduser(
         os.path.join(config.get("output_dir"), "videos", config.get("session_folder"))
@@ -169,35 +424,136 @@ def create_video(config, change_files):
     os.makedirs(video_output_dir, exist_ok=True, mode=0o777)
 
     video_clips = [
-        {"name": video_resolution["name"], "dimensions": video_resolution["dimensions"], "frames": []}
+        {"name": video_resolution["name"], "dimensions": video_resolution["dimensions"]}
         for video_resolution in config.get("video_resolutions")
     ]
-    logger.info("Creating frames...")
-    with multiprocessing.Pool(processes=None if config.get("multi_processing") else 1) as pool:
-        for clip_info in video_clips:
-            starmap_args = [
-                (change_file, clip_info["dimensions"], change_file["font_size"][f"{clip_info['name']}_video"])
-                for change_file in change_files
+    # The manuscript and audio do not depend on the frames, so they are generated on a thread while the
+    # frames are rendered and encoded. The payload is reduced before that, since with payload_interactive
+    # it reads from the terminal.
+    payload = create_payload(group_by_file(change_files), config, logger)
+    reduce_payload(payload, config, logger)
+
+    # Frames are encoded as soon as they are rendered. With hold_frames each snapshot is encoded once and
+    # held for video_frames frames' worth of time, instead of being encoded video_frames times.
+    if config.get("hold_frames"):
+        fps, repeat = fractions.Fraction(config.get("video_fps"), video_frames), 1
+    else:
+        fps, repeat = config.get("video_fps"), video_frames
+    # Workers render runs of snapshots of one file, each frame from the previous one
+    chunk_size = config.get("render_chunk_size") if config.get("incremental_render") else 1
+    segment_count = max(min(config.get("video_segments"), len(change_files)), 1)
+
+    # The gifs each frame of a resolution is added to, with the frame's index in its file's gif
+    gif_writers = {}
+    for (_, filepath), (video_name, writer) in (video_gifs or {}).items():
+        gif_writers.setdefault((video_name, filepath), []).append(writer)
+    file_indices = []
+    file_counts = collections.Counter()
+    for change_file in change_files:
+        file_indices.append(file_counts[change_file["filepath"]])
+        file_counts[change_file["filepath"]] += 1
+
+    # Every resolution, and with video_segments every part of its timeline, is encoded by its own ffmpeg
+    # process at the same time. The segments of a resolution are joined when the audio is added.
+    segments = []
+    for clip_info in video_clips:
+        output_filename = f"{config.get('name')}_{clip_info['dimensions'][0]}x{clip_info['dimensions'][1]}.mp4"
+        clip_info["output_filepath"] = os.path.join(video_output_dir, output_filename)
+        clip_info["video_filepaths"] = []
+        bounds = [round(i * len(change_files) / segment_count) for i in range(segment_count + 1)]
+        for index in range(segment_count):
+            if segment_count == 1:
+                video_filename = f"video_only_{output_filename}"
+            else:
+                video_filename = f"video_only_{index:03d}_{output_filename}"
+            clip_info["video_filepaths"].append(os.path.join(video_output_dir, video_filename))
+            frame_args = [
+                (
+                    change_file,
+                    clip_info["dimensions"],
+                    change_file["font_size"][f"{clip_info['name']}_video"],
+                    frame_cache,
+                    config.get("renderer"),
+                    config.get("incremental_render"),
+                )
+                for change_file in change_files[bounds[index] : bounds[index + 1]]
             ]
-            logger.info(f"Processing {clip_info['name']}_video")
-            for img in tqdm(pool.starmap(create_image, starmap_args), total=len(starmap_args)):
-                clip_info["frames"].extend([img] * video_frames)
+            frame_gifs = [
+                [
+                    (writer, file_indices[i])
+                    for writer in gif_writers.get((clip_info["name"], change_files[i]["filepath"]), [])
+                ]
+                for i in range(bounds[index], bounds[index + 1])
+            ]
+            segments.append((clip_info, clip_info["video_filepaths"][-1], frame_args, frame_gifs))
+
+    # About two chunks per worker keep the pool busy while the encoders catch up. frame_window caps the
+    # frames in flight across all of them, to bound memory. The files share that budget, so whichever
+    # encoder is ready can use the whole pool instead of a fixed share of it.
+    window = max(min(2 * get_worker_count(config), config.get("frame_window") // chunk_size), 1)
+    slot_groups = PermitPool(range(window))
+    shared_memory = config.get("shared_memory_frames")
+    # One ring for all the files, with a group of chunk_size slots for each task in flight. Slots fit the
+    # largest resolution, so the ring holds at most frame_window frames whatever the number of files.
+    frame_size = max(clip_info["dimensions"][0] * clip_info["dimensions"][1] * 3 for clip_info in video_clips)
+    ring_size = window * chunk_size * frame_size
+    if shared_memory and not shared_memory_fits(ring_size):
+        logger.warning(f"Not enough shared memory for {ring_size} bytes of frames, sending frames through the pool.")
+        shared_memory = False
+    logger.info(f"Creating frames for {len(video_clips)} resolutions in {len(segments)} parts...")
+    narration_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    narration = narration_executor.submit(create_narration, payload, config)
+    with contextlib.ExitStack() as stack:
+        ring = stack.enter_context(FrameRing(frame_size, window * chunk_size)) if shared_memory else None
+        progress = stack.enter_context(tqdm(total=len(change_files) * len(video_clips)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [
+                executor.submit(
+                    encode_video,
+                    pool,
+                    video_filepath,
+                    clip_info["dimensions"],
+                    fps,
+                    frame_args,
+                    repeat,
+                    chunk_size,
+                    window,
+                    slot_groups,
+                    progress,
+                    ring,
+                    frame_gifs,
+                )
+                for clip_info, video_filepath, frame_args, frame_gifs in segments
+            ]
+            results = [future.result() for future in futures]
 
-    grouped_change_files = change_files = group_by_file(change_files)
-    payload = create_payload(grouped_change_files, config, logger)
-    manuscript = get_manuscript(payload, config, logger)
-    audio_file = text_to_speech(manuscript, config, logger)
-    audio_clip = AudioFileClip(audio_file)
+    for clip_info in video_clips:
+        clip_info["duration"] = 0
+    for (clip_info, _, _, _), (duration, hits, misses) in zip(segments, results):
+        clip_info["duration"] += duration
+        if frame_cache:
+            frame_cache.hits += hits
+            frame_cache.misses += misses
+
+    if not narration.done():
+        logger.info("Waiting for the manuscript and audio...")
+    audio_file = narration.result()
+    narration_executor.shutdown()
 
     logger.info("Creating videos...")
     for clip_info in video_clips:
-        logger.info(f"clips: {len(clip_info['frames'])} - {clip_info['name']}_video")
-        if clip_info["frames"]:
-            clip = ImageSequenceClip(clip_info['frames'], fps=config.get("video_fps"))
-            output_filename = f"{config.get('name')}_{clip_info['dimensions'][0]}x{clip_info['dimensions'][1]}.mp4"
-            output_filepath = os.path.join(video_output_dir, output_filename)
-            clip = clip.set_audio(audio_clip)
-            clip.write_videofile(output_filepath, fps=config.get("video_fps"))
+        logger.info(f"duration: {clip_info['duration']:.2f}s - {clip_info['name']}_video")
+        mux_audio(clip_info["video_filepaths"], audio_file, clip_info["output_filepath"], clip_info["duration"])
+        for video_filepath in clip_info["video_filepaths"]:
+            os.remove(video_filepath)
+
+    # get_manuscript only updates the progress for this run, keep it now that the video is written
+    config.set("total_progress", config.get("total_progress"))
+    config.write()
+
+
+def get_worker_count(config):
+    return (os.cpu_count() or 1) if config.get("multi_processing") else 1
 
 
 def preprocess_change_files(config, change_files):
@@ -240,63 +596,52 @@ def preprocess_change_files(config, change_files):
 
 
 def get_widest_files(change_files):
-    max_widths = {filepath: 0 for filepath in set([change_file["filepath"] for change_file in change_files])}
+    max_widths = {filepath: -1 for filepath in set([change_file["filepath"] for change_file in change_files])}
     max_width_indices = {}
     logger.info("Determining widest change file per file path...")
-    for file_index, change_file in tqdm(enumerate(change_files), total=len(change_files)):
-        extended_content = add_filler_lines(change_file)
-        code_image = np.frombuffer(
-            highlight_code(extended_content, change_file["language"], font_size=1), dtype=np.uint8
-        )
-        code_image = cv2.imdecode(code_image, cv2.IMREAD_UNCHANGED)
-        if code_image.shape[1] > max_widths[change_file["filepath"]]:
-            max_widths[change_file["filepath"]] = code_image.shape[1]
+    for file_index, change_file in enumerate(change_files):
+        _, max_line_length = measure_text(add_filler_lines(change_file))
+        if max_line_length > max_widths[change_file["filepath"]]:
+            max_widths[change_file["filepath"]] = max_line_length
             max_width_indices[change_file["filepath"]] = file_index
     logger.info("Done.")
     return max_width_indices
 
 
-def get_font_size(change_file, resolution, type):
+def get_font_size(change_file, resolution, type, renderer="pygments"):
     logger.info(f"Determining font size for: {change_file['filepath']} for {resolution['name']} {type}")
     header_size = add_header(change_file)
     extended_content = add_filler_lines(change_file)
     longest_line = max([len(line) for line in extended_content.split("\n")])
     max_code_height = resolution["dimensions"][1] - header_size[1]
-
-    high = min(500 * (20 / longest_line), 500)
-    low = 0
-    precision = 1
-    font_size = (high + low) / 2
-    best = low
-    while high - low > precision:
-        font_size = (high + low) / 2
-        code_image = np.frombuffer(
-            highlight_code(extended_content, change_file["language"], font_size=font_size), dtype=np.uint8
+    max_width = resolution["dimensions"][0]
+
+    # Fit the font size from the measured cell size, then render once to confirm it. Glyphs that
+    # overhang their cell can make the render a pixel wider than estimated, step down if they do.
+    line_count, max_line_length = measure_text(extended_content)
+    high = min(500 * (20 / max(longest_line, 1)), 500)
+    best = fit_font_size(line_count, max_line_length, max_code_height, max_width, high)
+    while best > 0:
+        code_image = render_code_image(
+            extended_content, change_file["language"], best, renderer, get_code_tokens(change_file, extended_content)
         )
-        code_image = cv2.imdecode(code_image, cv2.IMREAD_UNCHANGED)
-        code_image_width = code_image.shape[1]
-        code_image_height = code_image.shape[0]
-        wrap_count = math.ceil(code_image_height / max_code_height)
-        wrap_width = wrap_count * code_image_width
-        if wrap_width >= resolution["dimensions"][0]:
-            high = math.floor(font_size)
-        else:
-            best = math.floor(font_size)
-            low = math.floor(font_size)
+        code_image_height, code_image_width = code_image.shape[:2]
+        if math.ceil(code_image_height / max_code_height) * code_image_width < max_width:
+            break
+        best -= 1
 
     return (change_file['filepath'], f"{resolution['name']}_{type}", best - 1)
 
 
 def get_change_files(config):
-    changes_dir = os.path.expanduser(os.path.join(config.get("output_dir"), "changes"))
-    change_filenames = sorted(glob.glob(os.path.join(changes_dir, f"*")))
-    if not change_filenames:
+    change_files = load_change_files(os.path.expanduser(config.get("output_dir")), config.get("render_sessions"))
+    if not change_files:
         logger.error("No change files found.")
         exit(1)
-    change_files = [json.load(open(change_filename, "r")) for change_filename in change_filenames]
 
     change_files = preprocess_change_files(config, change_files)
     max_width_indices = get_widest_files(change_files)
+    tokenize_change_files(change_files)
 
     font_sizes = {}
 
@@ -306,10 +651,18 @@ def get_change_files(config):
             change_file = change_files[max_char_index]
             if config.get("video"):
                 starmap_args.extend(
-                    [(change_file, resolution, "video") for resolution in config.get("video_resolutions")]
+                    [
+                        (change_file, resolution, "video", config.get("renderer"))
+                        for resolution in config.get("video_resolutions")
+                    ]
                 )
             if config.get("gifs"):
-                starmap_args.extend([(change_file, resolution, "gif") for resolution in config.get("gif_resolutions")])
+                starmap_args.extend(
+                    [
+                        (change_file, resolution, "gif", config.get("renderer"))
+                        for resolution in config.get("gif_resolutions")
+                    ]
+                )
 
         logger.info("Fitting font sizes to desired resolutions...")
         for filepath, resolution_name, font_size in tqdm(
@@ -325,24 +678,41 @@ def get_change_files(config):
         return None
 
 
-def create_media():
+def create_media(regenerate_manuscript=False):
     from time import time
 
     start_time = time()
     project_dir = os.path.expanduser(input("Enter the path to the project directory: "))
     config_filepath = os.path.join(project_dir, "tracer.json")
     config = Config(config_filepath)
+    if regenerate_manuscript:
+        config.set("regenerate_manuscript", True, local=True)
 
     change_files = get_change_files(config)
 
+    frame_cache = None
+    if config.get("frame_cache"):
+        frame_cache_dir = os.path.join(os.path.expanduser(config.get("output_dir")), "frame_cache")
+        frame_cache = FrameCache(frame_cache_dir, config.get("frame_cache_size"))
+
     if config.get("group_by_file", True):
         change_files = group_by_file(change_files, flatten=True)
 
-    if config.get("video", False):
-        create_video(config, change_files)
-
-    if config.get("gifs", False):
-        create_gifs(config, change_files)
+    # One pool renders the video and the gifs. It is forked before the manuscript and audio are generated,
+    # as the OpenAI and gRPC clients start threads that forking while they run can deadlock, and so its
+    # workers inherit the tokens lexed by get_change_files.
+    video_gifs = {}
+    if config.get("video", False) and config.get("gifs", False):
+        video_gifs = get_video_gifs(config, change_files)
+    with multiprocessing.Pool(processes=get_worker_count(config)) as pool:
+        if config.get("video", False):
+            create_video(config, change_files, pool, frame_cache, video_gifs)
+
+        if config.get("gifs", False):
+            create_gifs(config, change_files, pool, frame_cache, video_gifs)
+
+    if frame_cache:
+        logger.info(f"Frame cache: {frame_cache.hits} hits, {frame_cache.misses} misses.")
 
     logger.info(f"Finished creating media in {time() - start_time} seconds.")
 
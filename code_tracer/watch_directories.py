@@ -1,10 +1,15 @@
-import fnmatch
-import os
 import json
+import os
 import time
-import glob
-from utils import Config, logger
+
 from constants import TIME_FORMAT
+from metrics import metrics
+from scanner import scan_paths
+from snapshot_writer import SnapshotWriter
+from source_files import read_source_file
+from storage import create_delta, hash_content, open_journal, write_blob
+from utils import Config, logger
+from watchers import Debouncer, create_watcher
 
 SUPPORTED_LANGUAGES = {
     ".py": "python",
@@ -24,47 +29,6 @@ def get_language(filepath):
     return SUPPORTED_LANGUAGES.get(file_extension, "text")
 
 
-def expand_wildcards(paths):
-    new_paths = []
-    for path in paths:
-        if os.path.isdir(path):
-            new_paths.extend(glob.glob(os.path.join(path, "**"), recursive=True))
-        elif "**" in path or "*" in path:
-            new_paths.extend(glob.glob(path, recursive=True))
-        else:
-            new_paths.append(path)
-    new_new_paths = []
-
-    for path in new_paths:
-        new_new_paths.append(path)
-        if os.path.isdir(path):
-            new_new_paths.extend(expand_wildcards(glob.glob(os.path.join(path, "**/.*"), recursive=True)))
-
-    new_new_paths = [path for path in new_new_paths if os.path.isfile(path)]
-
-    return new_new_paths
-
-
-def remove_ignored(paths, config):
-    ignored_paths = config.get("ignore")
-    logger.info(
-        "Removing"
-        f" {len([path for path in paths if any([fnmatch.fnmatch(path, ignore) for ignore in ignored_paths])])} ignored"
-        " paths"
-    )
-    return [path for path in paths if not any([fnmatch.fnmatch(path, ignore) for ignore in ignored_paths])]
-
-
-def get_paths(key, config):
-    logger.info(f"Getting {key} paths from config")
-    items = config.get(key)
-    items = [os.path.expanduser(item) for item in items]
-    items = [os.path.join(config.get("project_dir"), item) for item in items]
-    items = expand_wildcards(items)
-    logger.info(f"Found {len(items)} expanded paths for config['{key}']")
-    return items
-
-
 def watch_directories():
     project_dir = os.path.expanduser(input('Enter the path to the project directory: '))
     config_filepath = os.path.join(project_dir, 'tracer.json')
@@ -77,10 +41,13 @@ def watch_directories():
         config.append("all_sessions", session)
         config.write(config_filepath)
 
-    watch_items = get_paths('watch', config)
-    watch_items = remove_ignored(watch_items, config)
-    logger.info(f'Watching {len(watch_items)} items.')
-    logger.debug(f'Watch items: {watch_items}')
+    def get_watch_items():
+        watch_items = scan_paths('watch', config)
+        logger.debug(f'Watch items: {watch_items}')
+        return watch_items
+
+    watcher = create_watcher(config, get_watch_items)
+    logger.info(f'Watching {len(watcher)} items.')
 
     # Get the project name
     project_name = config.get("name")
@@ -92,18 +59,24 @@ def watch_directories():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir, mode=0o777)
 
-    # Initialize a dictionary to store the modification times of the watched files
-    last_modified_times = {filepath: os.path.getmtime(filepath) for filepath in watch_items}
+    # Initialize a dictionary to store the last snapshot of each file
+    history = {}
 
-    # Initialize a list to store the unreadable files
-    unreadable_files = []
+    # Open the change journal once for the whole session
+    journal = open_journal(output_dir, config) if config.get("storage_format") == "journal" else None
 
-    # Initialize a variable to store the total size of the copied files
-    total_size = 0
+    # Write snapshots in the background so reading and storing files never delays change detection
+    writer = SnapshotWriter(
+        lambda filepath, timestamp: copy_file(filepath, output_dir, timestamp, project_name, config, history, journal),
+        journal,
+        threads=config.get("writer_threads"),
+        queue_size=config.get("writer_queue_size"),
+    )
 
     # Log that the script has started
     logger.info('Code Tracer script started.')
-    logger.info('''
+    logger.info(
+        '''
 Always watching...
 ⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⢀⣀⣤⣤⣤⣤⣴⣤⣤⣄⡀⠀⠀⠀⠀⠀⠀⠀⠀⠀
 ⠀⠀⠀⠀⠀⠀⠀⣀⣴⣾⠿⠛⠋⠉⠁⠀⠀⠀⠈⠙⠻⢷⣦⡀⠀⠀⠀⠀⠀⠀
@@ -115,106 +88,157 @@ Always watching...
 ⠀⠀⠀⠀⠈⠙⠿⣾⣠⣆⣅⣀⣠⣄⣤⣴⣶⣾⣽⢿⠿⠟⠋⠀⠀⠀⠀⠀⠀⠀
 ⠀⠀⠀⠀⠀⠀⠀⠀⠀⠉⠙⠛⠛⠙⠋⠉⠉⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀
 (https://emojicombos.com/eye-ascii-art)
-''')
+'''
+    )
+
+    def save_changes(items):
+        for item in items:
+            writer.submit(item, time.strftime(TIME_FORMAT))
+
+    # Collapse bursts of saves to the same file before snapshotting it
+    debouncer = Debouncer(
+        config.get("debounce_seconds"), config.get("max_snapshots_per_minute"), config.get("debounce_max_seconds")
+    )
+
+    # Publish runtime metrics to a stats file and, when a port is configured, on localhost
+    metrics.set("interval_seconds", config.get("interval"))
+    metrics.set("watched_files", lambda: len(watcher))
+    metrics.set("debounce_pending", lambda: len(debouncer))
+    metrics.set("writer_queue_depth", lambda: len(writer))
+    stats_filepath = os.path.join(output_dir, "stats.json")
+    stats_time = 0
+    metrics_server = metrics.serve(config.get("metrics_port")) if config.get("metrics_port") else None
+
+    def write_stats():
+        try:
+            metrics.write_stats(stats_filepath)
+        except OSError as e:
+            logger.warning(f'Unable to write stats to {stats_filepath}: {e}')
 
     # Start the watch loop
     try:
-        start_time = time.time()
         while True:
-            if time.time() - start_time > 60:
-                logger.info("Reloading watch items...")
-                watch_items = get_paths('watch', config)
-                watch_items = remove_ignored(watch_items, config)
-                logger.info(f'Watching {len(watch_items)} items.')
-                logger.debug(f'Watch items: {watch_items}')
-                start_time = time.time()
-            for item in watch_items:
-                if file_has_changed(item, last_modified_times):
-                    if not os.path.exists(item):
-                        watch_items.remove(item)
-                    try:
-                        timestamp = time.strftime(TIME_FORMAT)
-                        size_changed = copy_file(item, output_dir, timestamp, project_name, config)
-                        total_size += size_changed
-                    except UnicodeDecodeError:
-                        unreadable_files.append(item)
-                        logger.warning(f'Unable to read file {item}.')
-
-            # Wait for the specified interval before checking for changes again
-            time.sleep(config.get("interval"))
+            changed = watcher.poll(debouncer.timeout())
+            metrics.inc("changes_detected_total", len(changed))
+            debouncer.add(changed)
+            save_changes(debouncer.ready())
+            # Stop watching files the writer found to be binary
+            for filepath in writer.take_quarantined():
+                watcher.quarantine(filepath)
+            if time.time() - stats_time >= config.get("stats_interval"):
+                write_stats()
+                stats_time = time.time()
 
     except KeyboardInterrupt:
+        # Save the final state of files that were still settling
+        debouncer.add(watcher.drain())
+        watcher.close()
+        save_changes(debouncer.flush())
+        # Wait for every queued snapshot to be written
+        logger.info(f'Writing {len(writer)} pending snapshots...')
+        writer.close()
+        if journal:
+            journal.close()
+        write_stats()
+        if metrics_server:
+            metrics_server.shutdown()
+
         # Log that the script has stopped
         logger.info('Code Tracer stopped.')
 
         # Display the unreadable files
-        if unreadable_files:
-            logger.warning(f'Unable to read {len(unreadable_files)} files:')
-            for file in unreadable_files:
+        if writer.unreadable_files:
+            logger.warning(f'Skipped {len(writer.unreadable_files)} binary or oversized files:')
+            for file in writer.unreadable_files:
                 logger.warning(f'- {file}')
 
         # Display the storage used by the copied files
-        logger.info(f'Total storage used: {human_readable_size(total_size)}')
-
-
-# Define the function to check if a file has changed since it was last checked
-def file_has_changed(filepath, last_modified_times):
-    # Check if the file has been seen before
-    if filepath in last_modified_times:
-        if not os.path.exists(filepath):
-            last_modified_times.pop(filepath)
-            logger.warning(f"File {filepath} no longer not exists.")
-            return True
-        # Check if the modification time has changed
-        if os.path.getmtime(filepath) > last_modified_times[filepath]:
-            # Update the modification time
-            last_modified_times[filepath] = os.path.getmtime(filepath)
-            return True
-    else:
-        # Add the file to the dictionary
-        if os.path.exists(filepath):
-            last_modified_times[filepath] = os.path.getmtime(filepath)
-        else:
-            logger.warning(f"File {filepath} no longer not exists.")
-        return True
+        logger.info(f'Total storage used: {human_readable_size(writer.total_size)}')
 
-    return False
 
-
-def copy_file(filepath, output_dir, timestamp, project_name, config):
+def copy_file(filepath, output_dir, timestamp, project_name, config, history=None, journal=None):
     language = get_language(filepath)
 
     if os.path.exists(filepath):
-        with open(filepath, "r", encoding="utf-8") as f:
-            content = f.read()
+        content = read_source_file(filepath, config.get("max_snapshot_size"), config.get("mmap_threshold"))
     else:
         content = ""
 
-    changes_dir = os.path.join(output_dir, "changes")
-    os.makedirs(changes_dir, exist_ok=True, mode=0o777)
+    # Skip saves that did not change the content (editor saves, checkouts, formatters)
+    content_hash = hash_content(content)
+    previous = history.get(filepath) if history is not None else None
+    if previous and previous["content_hash"] == content_hash:
+        logger.info(f'File {filepath} content unchanged, skipping.')
+        return 0
 
     updated_filepath = filepath.replace(os.path.sep, "__")
-    change_filename = f"{timestamp}{updated_filepath}.json"
-    change_filepath = os.path.join(changes_dir, change_filename)
-
     data = {
         "filepath": updated_filepath,
         "language": language,
-        "content": content,
+        "content_hash": content_hash,
+        "size": len(content.encode("utf-8")),
         "project_name": project_name,
         "github_username": config.get("github_username"),
         "session": config.get("session"),
     }
 
-    with open(change_filepath, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    if config.get("storage_format") == "journal":
+        data["timestamp"] = timestamp
+        if journal is None:
+            journal = open_journal(output_dir, config)
+            close_journal = True
+        else:
+            close_journal = False
+        change_filepath = None
+    else:
+        changes_dir = os.path.join(output_dir, "changes")
+        os.makedirs(changes_dir, exist_ok=True, mode=0o777)
+        change_filename = f"{timestamp}{updated_filepath}.json"
+        change_filepath = os.path.join(changes_dir, change_filename)
+
+    # In delta mode store a line diff against the previous snapshot, with a full keyframe every
+    # keyframe_interval changes (or when the previous snapshot would be overwritten)
+    deltas = 0
+    blob_size = 0
+    if (
+        config.get("storage_mode") == "delta"
+        and previous
+        and previous["deltas"] + 1 < config.get("keyframe_interval")
+        and not (change_filepath and os.path.exists(change_filepath))
+    ):
+        data["base_hash"] = previous["content_hash"]
+        data["delta"] = create_delta(previous["content"], content)
+        deltas = previous["deltas"] + 1
+    elif config.get("blob_store"):
+        # Store the content once in the blob store and only reference it from the snapshot
+        if change_filepath:
+            blob_size = write_blob(output_dir, content, content_hash)
+        else:
+            blob_size = journal.write_blob(content_hash, content)
+    else:
+        data["content"] = content
+
+    if change_filepath:
+        with open(change_filepath, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        # Calculate the size of the new file
+        new_file_size = os.path.getsize(change_filepath) + blob_size
+    else:
+        new_file_size = journal.append(data)[3] + blob_size
+        change_filepath = journal.journal_dir
+        if close_journal:
+            journal.close()
+
+    if history is not None:
+        history[filepath] = {
+            "content_hash": content_hash,
+            "content": content if config.get("storage_mode") == "delta" else None,
+            "deltas": deltas,
+        }
 
     # Log that the file has been saved
     logger.info(f'File {filepath} updates saved to {change_filepath}.')
 
-    # Calculate the size of the new file
-    new_file_size = os.path.getsize(change_filepath)
-
     return new_file_size
 
 
@@ -0,0 +1,398 @@
+import collections
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import struct
+import sys
+import time
+
+from metrics import metrics
+from scanner import IgnoreMatcher, scan_tree
+from utils import logger
+
+# inotify event masks (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+EVENT_HEADER = struct.Struct("iIII")
+RELOAD_SECONDS = 60
+RATE_WINDOW_SECONDS = 60
+
+
+# Define the function to check if a file has changed since it was last checked
+def file_has_changed(filepath, last_modified_times):
+    # Check if the file has been seen before
+    if filepath in last_modified_times:
+        if not os.path.exists(filepath):
+            last_modified_times.pop(filepath)
+            logger.warning(f"File {filepath} no longer not exists.")
+            return True
+        # Check if the modification time has changed
+        if os.path.getmtime(filepath) > last_modified_times[filepath]:
+            # Update the modification time
+            last_modified_times[filepath] = os.path.getmtime(filepath)
+            return True
+    else:
+        # Add the file to the dictionary
+        if os.path.exists(filepath):
+            last_modified_times[filepath] = os.path.getmtime(filepath)
+        else:
+            logger.warning(f"File {filepath} no longer not exists.")
+        return True
+
+    return False
+
+
+class PollingWatcher:
+    name = "polling"
+
+    def __init__(self, config, get_watch_items):
+        self.config = config
+        self.get_watch_items = get_watch_items
+        self.watch_items = get_watch_items()
+        self.last_modified_times = {filepath: os.path.getmtime(filepath) for filepath in self.watch_items}
+        self.reload_time = time.time()
+        self.quarantined = set()
+
+    def __len__(self):
+        return len(self.watch_items)
+
+    def discard(self, filepath):
+        if filepath in self.watch_items:
+            self.watch_items.remove(filepath)
+        self.last_modified_times.pop(filepath, None)
+
+    # Stop watching a file for the rest of the session, even when the watch items are reloaded
+    def quarantine(self, filepath):
+        self.quarantined.add(filepath)
+        self.discard(filepath)
+
+    def poll(self, timeout=None):
+        # Wait for the specified interval before checking for changes again
+        time.sleep(self.config.get("interval"))
+        return self.drain()
+
+    # Check for changes without waiting
+    def drain(self):
+        start = time.perf_counter()
+        if time.time() - self.reload_time > RELOAD_SECONDS:
+            logger.info("Reloading watch items...")
+            self.watch_items = [item for item in self.get_watch_items() if item not in self.quarantined]
+            logger.info(f'Watching {len(self.watch_items)} items.')
+            self.reload_time = time.time()
+
+        changed = [item for item in self.watch_items if file_has_changed(item, self.last_modified_times)]
+        for item in changed:
+            if not os.path.exists(item) and item in self.watch_items:
+                self.watch_items.remove(item)
+        metrics.observe("scan_duration_seconds", time.perf_counter() - start)
+        metrics.inc("files_stat_total", len(self.watch_items))
+        metrics.set("files_stat_per_scan", len(self.watch_items))
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    name = "inotify"
+
+    def __init__(self, config, get_watch_items):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.config = config
+        self.get_watch_items = get_watch_items
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        self.watch_descriptors = {}
+        self.ignore = IgnoreMatcher(config.get("ignore"))
+        self.quarantined = set()
+        self.specs = self._get_specs()
+        self.watch_items = set(get_watch_items())
+        # Takes over once a directory can no longer be watched, e.g. at fs.inotify.max_user_watches
+        self.polling = None
+        try:
+            for spec_type, root, _ in self.specs:
+                if spec_type == "file":
+                    self._add_watch(root)
+                else:
+                    self._add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self.polling) if self.polling else len(self.watch_items)
+
+    def _get_specs(self):
+        # Like scan_paths, every watch item is relative to the project directory
+        specs = []
+        for item in self.config.get("watch"):
+            path = os.path.join(self.config.get("project_dir"), os.path.expanduser(item))
+            if os.path.isdir(path):
+                specs.append(("tree", path.rstrip(os.sep) or os.sep, path))
+            elif "*" in path:
+                root = os.path.dirname(path.split("*", 1)[0])
+                specs.append(("glob", root or os.sep, path))
+            else:
+                specs.append(("file", os.path.dirname(path), path))
+        return specs
+
+    def _matches(self, path):
+        if path in self.quarantined or self.ignore(path):
+            return False
+        for spec_type, root, spec_path in self.specs:
+            if spec_type == "tree" and path.startswith(root + os.sep):
+                return True
+            if spec_type == "glob" and fnmatch.fnmatch(path, spec_path):
+                return True
+            if spec_type == "file" and path == spec_path:
+                return True
+        return False
+
+    def _add_watch(self, directory):
+        if directory in self.directories or not os.path.isdir(directory):
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch failed for {directory}: {os.strerror(errno)}")
+        self.directories[directory] = wd
+        self.watch_descriptors[wd] = directory
+
+    def _add_tree(self, root):
+        # Watch every directory under root, without descending into ignored directories
+        found = []
+        for directory, files in scan_tree(root, self.ignore):
+            self._add_watch(directory)
+            metrics.inc("files_stat_total", len(files))
+            found.extend(path for path in files if self._matches(path))
+        return found
+
+    def _remove_tree(self, root):
+        removed = [path for path in self.watch_items if path.startswith(root + os.sep)]
+        directories = [
+            directory for directory in self.directories if directory == root or directory.startswith(root + os.sep)
+        ]
+        for directory in directories:
+            wd = self.directories.pop(directory)
+            self.watch_descriptors.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+        for path in removed:
+            self.watch_items.discard(path)
+        return removed
+
+    def discard(self, filepath):
+        self.watch_items.discard(filepath)
+        if self.polling:
+            self.polling.discard(filepath)
+
+    # Stop watching a file for the rest of the session, even when it changes again
+    def quarantine(self, filepath):
+        self.quarantined.add(filepath)
+        self.discard(filepath)
+        if self.polling:
+            self.polling.quarantine(filepath)
+
+    def _read_events(self):
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                yield wd, mask, name
+
+    def _rescan(self):
+        logger.warning("inotify event queue overflowed, rescanning watch items...")
+        current = set(self.get_watch_items()) - self.quarantined
+        changed = current | self.watch_items
+        self.watch_items = current
+        for spec_type, root, _ in self.specs:
+            if spec_type != "file":
+                self._add_tree(root)
+        return changed
+
+    # Poll the watch items for the rest of the session. Like after an overflow, every watch item is
+    # reported as changed, since changes may have been missed.
+    def _fall_back_to_polling(self, error):
+        logger.warning(f"Unable to keep watching with inotify ({error}), falling back to polling.")
+        self.close()
+        self.polling = PollingWatcher(self.config, self.get_watch_items)
+        for filepath in self.quarantined:
+            self.polling.quarantine(filepath)
+        return set(self.polling.watch_items) | self.watch_items
+
+    def poll(self, timeout=None):
+        if self.polling:
+            return self.polling.poll(timeout)
+        timeout = self.config.get("interval") if timeout is None else min(timeout, self.config.get("interval"))
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        start = time.perf_counter()
+        try:
+            changed = self._read_changes()
+        except OSError as e:
+            changed = self._fall_back_to_polling(e)
+        metrics.observe("scan_duration_seconds", time.perf_counter() - start)
+        return sorted(changed)
+
+    def _read_changes(self):
+        changed = set()
+        for wd, mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                changed |= self._rescan()
+                continue
+            directory = self.watch_descriptors.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(directory, None)
+                self.watch_descriptors.pop(wd, None)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.update(self._remove_tree(directory))
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    new_items = self._add_tree(path)
+                    self.watch_items.update(new_items)
+                    changed.update(new_items)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    changed.update(self._remove_tree(path))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                if path in self.watch_items:
+                    self.watch_items.discard(path)
+                    changed.add(path)
+            elif path in self.watch_items or self._matches(path):
+                if path not in self.watch_items:
+                    logger.info(f"Watching new file {path}.")
+                self.watch_items.add(path)
+                changed.add(path)
+        return changed
+
+    # Collect the events that are already queued without waiting
+    def drain(self):
+        if self.polling:
+            return self.polling.drain()
+        return self.poll(0)
+
+    def close(self):
+        if self.polling:
+            self.polling.close()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+# Collapse bursts of saves: a file is only snapshotted once it has been quiet for quiet_period
+# seconds, and at most max_per_minute times per minute. A file that keeps changing is still
+# snapshotted max_delay seconds after its first held back change. Held back changes keep their final
+# state.
+class Debouncer:
+    def __init__(self, quiet_period, max_per_minute, max_delay=None):
+        self.quiet_period = quiet_period
+        self.max_per_minute = max_per_minute
+        self.max_delay = max_delay
+        # (first, last) change time of each held back file
+        self.pending = {}
+        self.snapshot_times = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, filepaths, now=None):
+        now = time.time() if now is None else now
+        for filepath in filepaths:
+            first_time = self.pending[filepath][0] if filepath in self.pending else now
+            self.pending[filepath] = (first_time, now)
+
+    def _due_time(self, filepath):
+        first_time, last_time = self.pending[filepath]
+        due_time = last_time + self.quiet_period
+        if self.max_delay:
+            due_time = min(due_time, first_time + self.max_delay)
+        snapshot_times = self.snapshot_times.get(filepath)
+        if self.max_per_minute and snapshot_times and len(snapshot_times) >= self.max_per_minute:
+            due_time = max(due_time, snapshot_times[0] + RATE_WINDOW_SECONDS)
+        return due_time
+
+    def ready(self, now=None):
+        now = time.time() if now is None else now
+        ready = []
+        for filepath in list(self.pending):
+            snapshot_times = self.snapshot_times.setdefault(filepath, collections.deque())
+            while snapshot_times and snapshot_times[0] + RATE_WINDOW_SECONDS <= now:
+                snapshot_times.popleft()
+            if self._due_time(filepath) <= now:
+                del self.pending[filepath]
+                snapshot_times.append(now)
+                ready.append(filepath)
+        return ready
+
+    # Seconds until the next pending file becomes ready, or None when nothing is pending
+    def timeout(self, now=None):
+        if not self.pending:
+            return None
+        now = time.time() if now is None else now
+        return max(0, min(self._due_time(filepath) for filepath in self.pending) - now)
+
+    def flush(self):
+        ready = list(self.pending)
+        self.pending.clear()
+        return ready
+
+
+WATCHERS = {
+    "inotify": InotifyWatcher,
+    "polling": PollingWatcher,
+}
+
+
+def create_watcher(config, get_watch_items):
+    backend = config.get("watch_backend")
+    if backend not in WATCHERS:
+        logger.warning(f"Unknown watch_backend '{backend}', using polling.")
+        backend = "polling"
+    try:
+        watcher = WATCHERS[backend](config, get_watch_items)
+    except OSError as e:
+        logger.warning(f"Unable to start {backend} watcher ({e}), falling back to polling.")
+        watcher = PollingWatcher(config, get_watch_items)
+    logger.info(f"Using {watcher.name} watcher.")
+    return watcher
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules import each other by name, the way they are run from the code_tracer directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code_tracer"))
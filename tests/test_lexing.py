@@ -0,0 +1,106 @@
+import os
+import random
+
+import pytest
+
+from lexing import TokenCache, get_lexer
+
+CODE_TRACER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code_tracer")
+
+PYTHON = '''import os
+
+
+def first():
+    x = 1
+    return x
+
+
+def second(path):
+    """
+    return os.path.join(path, "name")
+
+
+def third():
+    # A comment
+    return 3
+'''
+
+JAVASCRIPT = '''function first() {
+  const x = 1;
+  return x;
+}
+
+/*
+function second(path) {
+  return `${path}/name`;
+}
+
+function third() {
+  // A comment
+  return 3 / 2;
+}
+'''
+
+
+# Apply edits one after the other, as the snapshots of a file, and check every snapshot is lexed the same
+# incrementally as from scratch
+def check_edits(language, text, edits):
+    cache = TokenCache()
+    lexer = get_lexer(language)
+    assert cache.get_tokens("file", language, text) == list(lexer.get_tokens(text))
+    for old, new in edits:
+        assert old in text
+        text = text.replace(old, new, 1)
+        assert cache.get_tokens("file", language, text) == list(lexer.get_tokens(text))
+
+
+def test_python_multi_line_strings():
+    check_edits(
+        "python",
+        PYTHON,
+        [
+            # Closing the docstring turns it from an unterminated string into a docstring
+            ('"name")\n\n\n', '"name")\n    """\n\n\n'),
+            ("# A comment", "# A longer comment"),
+            ('    """\n\n\n', "\n\n\n"),
+            ("    x = 1\n", "    x = '''\n"),
+            ("    return 3\n", "    return 3\n'''\n"),
+            ("    x = '''\n", "    x = 1\n"),
+        ],
+    )
+
+
+def test_javascript_multi_line_comments_and_strings():
+    check_edits(
+        "javascript",
+        JAVASCRIPT,
+        [
+            # Closing the comment turns the functions after it back into code
+            ("/*\n", "/* A comment */\n"),
+            ("  const x = 1;", "  const x = `\n"),
+            ("  return 3 / 2;", "  return `3` / 2;"),
+            ("  const x = `\n", "  const x = 1;"),
+            ("/* A comment */\n", "/*\n"),
+            ("  return `3` / 2;", "  return `3` / 2; */"),
+        ],
+    )
+
+
+@pytest.mark.parametrize("language, filename", [("python", "lexing.py"), ("javascript", None)])
+def test_random_edits(language, filename):
+    if filename is None:
+        text = JAVASCRIPT * 4
+    else:
+        with open(os.path.join(CODE_TRACER_DIR, filename)) as f:
+            text = f.read()
+    cache = TokenCache()
+    lexer = get_lexer(language)
+    snippets = ['"""', "'''", "'", '"', "`", "/*", "*/", "#", "//", "/", "\\", "(", ")", "{", "}", "\n", " "]
+    rng = random.Random(0)
+    for _ in range(100):
+        position = rng.randrange(len(text) + 1)
+        if rng.random() < 0.6:
+            text = text[:position] + rng.choice(snippets) + text[position:]
+        else:
+            text = text[:position] + text[position + rng.randrange(1, 20) :]
+        assert cache.get_tokens("file", language, text) == list(lexer.get_tokens(text))
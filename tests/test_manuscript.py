@@ -0,0 +1,94 @@
+import json
+import os
+import socket
+
+import pytest
+
+import get_manuscript as get_manuscript_module
+from constants import DEFAULTS
+from get_manuscript import create_payload, get_manuscript, reduce_payload
+from utils import Config, logger
+
+RESPONSE = {"manuscript": "Added `main` to a.py.", "total_progress": "A first file."}
+
+
+@pytest.fixture(autouse=True)
+def no_network(monkeypatch):
+    def refuse(*args, **kwargs):
+        raise OSError("network access in a test")
+
+    monkeypatch.setattr(socket, "getaddrinfo", refuse)
+    monkeypatch.setattr(socket.socket, "connect", refuse)
+
+
+@pytest.fixture
+def config(tmp_path):
+    (tmp_path / "context.txt").write_text("Describe the changes.")
+    replay_filepath = tmp_path / "gpt_api_response.json"
+    replay_filepath.write_text(json.dumps({"choices": [{"message": {"content": json.dumps(RESPONSE)}}]}))
+    config_filepath = tmp_path / "tracer.json"
+    config_filepath.write_text(
+        json.dumps(
+            {
+                **DEFAULTS,
+                "project_name": "project",
+                "output_dir": str(tmp_path / "output"),
+                "context_filepath": str(tmp_path / "context.txt"),
+                "manuscript_backend": "replay",
+                "manuscript_replay_filepath": str(replay_filepath),
+                # Small enough that the payload would have to be counted with tiktoken
+                "payload_token_budget": 16,
+            }
+        )
+    )
+    config = Config(str(config_filepath))
+    video_output_dir = tmp_path / "video"
+    video_output_dir.mkdir()
+    config.set("video_output_dir", str(video_output_dir), local=True)
+    return config
+
+
+def create_reduced_payload(config):
+    change_files = {"a.py": [{"content": "def main():\n    pass\n"}]}
+    payload = create_payload(change_files, config, logger)
+    reduce_payload(payload, config, logger)
+    return payload
+
+
+def test_replay_runs_offline(config):
+    payload = create_reduced_payload(config)
+
+    assert "a.py" in payload["changes"]
+    assert get_manuscript(payload, config, logger, reduce=False) == "Added 'main' to a.py."
+    assert config.get("total_progress") == RESPONSE["total_progress"]
+    assert os.listdir(os.path.join(config.get("output_dir"), "manuscript_cache"))
+
+
+def test_cached_response_is_reused(config):
+    payload = create_reduced_payload(config)
+    get_manuscript(payload, config, logger, reduce=False)
+
+    os.remove(config.get("manuscript_replay_filepath"))
+    assert get_manuscript(payload, config, logger, reduce=False) == "Added 'main' to a.py."
+
+    config.set("regenerate_manuscript", True, local=True)
+    with pytest.raises(FileNotFoundError):
+        get_manuscript(payload, config, logger, reduce=False)
+
+
+def test_replayed_response_is_not_used_for_the_api(config, monkeypatch):
+    payload = create_reduced_payload(config)
+    get_manuscript(payload, config, logger, reduce=False)
+
+    api_response = {"manuscript": "Wrote `main` in a.py.", "total_progress": "A first file."}
+
+    class APIBackend:
+        def __init__(self, api_key):
+            pass
+
+        def complete(self, model, messages):
+            return {"choices": [{"message": {"content": json.dumps(api_response)}}]}
+
+    monkeypatch.setattr(get_manuscript_module, "OpenAIBackend", APIBackend)
+    config.set("manuscript_backend", "openai", local=True)
+    assert get_manuscript(payload, config, logger, reduce=False) == "Wrote 'main' in a.py."